@@ -15,43 +15,105 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
-import configargparse
 from bullkit import Bullkit
+import rules
+import settings
 
-def main(*arg):
-	# Parse command line options.
-	commandargs = configargparse.ArgumentParser(description='This script performs various security checks on an Amazon Web Services account.')
-	commandargs.add_argument('-v', env_var='VERBOSE', action="store_true", default=False, help='Print additional debugging output to stderr.')
-	commandargs.add_argument('--no-slack', env_var='NO_SLACK', action="store_true", default=False, help='Print output to stdout rather than Slack.')
-	commandargs.add_argument('--slack-token', env_var='SLACK_TOKEN', help='Your Slack API token. Required unless you use --no-slack.')
-	commandargs.add_argument('--mfa', env_var='MFA', action="store_true", default=False, help='Check for IAM users that don\'t have MFA enabled.')
-	commandargs.add_argument('--mfa-channel', env_var='MFA_CHANNEL', help='The Slack channel to which we should post the results of the IAM user MFA check.')
-	commandargs.add_argument('--mfa-nag-users', env_var='MFA_NAG_USERS', action="store_true", default=False, help='Send Slack messages directly to users who need to enable MFA. Relies on a properly populated users.yml file.')
-	commandargs.add_argument('--public-s3', env_var='PUBLIC_S3', action="store_true", default=False, help='Check for public S3 buckets.')
-	commandargs.add_argument('--public-s3-channel', env_var='PUBLIC_S3_CHANNEL', help='The Slack channel to which we should post the results of the public S3 bucket check.')
-	commandargs.add_argument('--iam-keys', env_var='IAM_KEYS', action="store_true", default=False, help='Check for expired IAM access keys.')
-	commandargs.add_argument('--iam-keys-channel', env_var='IAM_KEYS_CHANNEL', help='The Slack channel to which we should post the results of the expired IAM access key check.')
-	commandargs.add_argument('--iam-keys-nag-users', env_var='IAM_KEYS_NAG_USERS', action="store_true", default=False, help='Send Slack messages directly to users who need to disable expired IAM access keys. Relies on a properly populated users.yml file.')
-	commandargs.add_argument('--iam-keys-warn-age', env_var='IAM_KEYS_WARN_AGE', help='The age (in days) of IAM access keys after which we should start sending warnings.')
-	commandargs.add_argument('--iam-keys-expire-age', env_var='IAM_KEYS_EXPIRE_AGE', help='The age (in days) that IAM access keys are not allowed to exceed.')
-
-	bk = Bullkit(commandargs)
-
-	if commandargs.parse_args().mfa:
+# Run the checks against the account we're running in, unless we're already out of time. Their rules are evaluated in a single pass, so the data they share (like the list of users) is only fetched once.
+def run_checks(bk, checks):
+	checks = [check for check in checks if not bk.out_of_time(check.__name__)]
+	results = rules.scan(bk, [check.RULE for check in checks])
+
+	for check in checks:
+		# Checks that are spread over several runs have nothing to report until they've finished a full sweep.
+		if results[check.__name__] is None:
+			bk.debug('{} is part way through a sweep, so there\'s nothing to report yet.'.format(check.__name__))
+			continue
+		with bk.checking(check.__name__):
+			bk.report(check, results[check.__name__])
+
+# Work out which checks we've been asked to run.
+def enabled_checks(my_settings):
+	checks = []
+
+	if my_settings.mfa:
 		import mfa
-		mfa.mfa(bk)
+		checks.append(mfa)
 
-	if commandargs.parse_args().public_s3:
+	if my_settings.public_s3:
 		import publics3
-		publics3.publics3(bk)
+		checks.append(publics3)
 
-	if commandargs.parse_args().iam_keys:
+	if my_settings.iam_keys:
 		import iamkeys
-		iamkeys.iamkeys(bk)
+		checks.append(iamkeys)
+
+	return checks
+
+# Save what we found for the next run, wait for our Slack messages to be sent, then write out our metrics. Returns what to tell whoever invoked us.
+def finish(bk):
+	bk.close_finding_store()
+	bk.close_finding_pipeline()
+	bk.flush_slack_messages()
+	bk.close_metrics()
+
+	# Tell whoever invoked us if any checks didn't finish.
+	if bk.cut_short:
+		result = 'AWS Security Bot ran out of time before finishing: {}'.format(', '.join(sorted(bk.cut_short)))
+		bk.stderr(result)
+		return result
 
 	return "AWS Security Bot ran succesfully."
 
+def main(*arg):
+	# Parse command line options.
+	my_settings = settings.load()
+
+	# If we've been asked to run as a server, answer queries until we're interrupted.
+	if my_settings.serve:
+		import server
+		server.serve(my_settings)
+		return "AWS Security Bot stopped serving."
+
+	bk = Bullkit(my_settings)
+	checks = enabled_checks(my_settings)
+
+	# If we're running in Lambda, work out when we need to stop.
+	if len(arg) > 1 and hasattr(arg[1], 'get_remaining_time_in_millis'):
+		bk.set_deadline(arg[1].get_remaining_time_in_millis() / 1000.0)
+
+	# If we've been given a file of CloudTrail events, only check the users and buckets they affect.
+	if my_settings.event_file:
+		import events
+		with open(my_settings.event_file, 'r') as stream:
+			events.handle(bk, json.load(stream), checks)
+
+	# If we've been told to check other accounts, scan all of them and report their combined results.
+	elif my_settings.accounts or my_settings.organization_accounts:
+		import organization
+		organization.check_accounts(bk, checks)
+
+	# Otherwise, run the checks against the account we're running in.
+	elif checks:
+		run_checks(bk, checks)
+
+	return finish(bk)
+
+# Handle CloudTrail events, delivered one at a time or in batches (e.g. by EventBridge or SQS), by checking only the users and buckets they affect. This is the Lambda handler for events, as main() is for scheduled runs.
+def handle_events(event, context=None):
+	my_settings = settings.load()
+	bk = Bullkit(my_settings)
+
+	# Work out when we need to stop.
+	if hasattr(context, 'get_remaining_time_in_millis'):
+		bk.set_deadline(context.get_remaining_time_in_millis() / 1000.0)
+
+	import events
+	events.handle(bk, event, enabled_checks(my_settings))
+	return finish(bk)
+
 # Only execute main() if we're being executed, not if we're being imported.
 if __name__ == "__main__":
 	main()
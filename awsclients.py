@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import json
+import threading
+import time
+from botocore.config import Config
+
+# The read-only API calls that describe a whole account, which several parts of a run may make (e.g. every check needs the account ID, and events and scans both list the users). Making the same call twice in one run gets the same answer, so only the first is sent. Calls about a single user or bucket aren't remembered: they're made once per resource anyway, and keeping every response would hold the whole account in memory for the rest of the run.
+MEMOIZED_OPERATIONS = {
+	('iam', 'GetCredentialReport'),
+	('iam', 'ListUsers'),
+	('organizations', 'ListAccounts'),
+	('s3', 'ListBuckets'),
+	('s3control', 'GetPublicAccessBlock'),
+	('sts', 'GetCallerIdentity'),
+}
+
+# How long (in seconds) to wait for another thread that's making the same call, before giving up and making it ourselves.
+IN_FLIGHT_TIMEOUT = 60
+
+# Limits how many requests we send per second, allowing short bursts. Shared by every client made by a factory. It holds at least one token, so rates below one request per second still let requests through.
+class TokenBucket:
+	def __init__(self, rate):
+		self.rate = rate
+		self.capacity = max(1, rate)
+		self.tokens = self.capacity
+		self.updated = time.time()
+		self.lock = threading.Lock()
+
+	# Wait until a token is available, and take it.
+	def take(self):
+		while True:
+			with self.lock:
+				now = time.time()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+# A call that's been made (or is being made) during this run, and its response.
+class MemoizedCall:
+	def __init__(self):
+		self.done = threading.Event()
+		self.response = None
+
+# Makes the boto3 clients and resources for a session, and shares them between checks. Every client uses the same connection pool size and retry mode, and their requests share a token bucket. Identical account-wide read-only calls are only sent to AWS once, however many checks make them.
+class ClientFactory:
+	def __init__(self, bullkit, session):
+		self.bullkit = bullkit
+		self.session = session
+		self.session_lock = threading.Lock()
+		self.clients = {}
+		self.lock = threading.Lock()
+		self.memoized_calls = {}
+
+		settings = bullkit.settings
+		self.config = Config(max_pool_connections=settings.aws_max_pool_connections, retries={'mode': settings.aws_retry_mode, 'max_attempts': settings.aws_max_attempts})
+		self.token_bucket = TokenBucket(settings.aws_requests_per_second) if settings.aws_requests_per_second > 0 else None
+
+	# Get a client, creating it if we haven't already. Sessions aren't thread-safe, so only one thread may use ours at a time.
+	def client(self, service_name, region_name=None, max_pool_connections=None):
+		key = ('client', service_name, region_name, max_pool_connections)
+		with self.session_lock:
+			if key not in self.clients:
+				config = self.config if max_pool_connections is None else self.config.merge(Config(max_pool_connections=max_pool_connections))
+				self.clients[key] = self.session.client(service_name, region_name=region_name, config=config)
+				self.register(self.clients[key])
+			return self.clients[key]
+
+	def resource(self, service_name, region_name=None):
+		key = ('resource', service_name, region_name)
+		with self.session_lock:
+			if key not in self.clients:
+				self.clients[key] = self.session.resource(service_name, region_name=region_name, config=self.config)
+				self.register(self.clients[key].meta.client)
+			return self.clients[key]
+
+	# Hook into a client's calls. Our metrics are hooked in last, so they only time calls that are sent to AWS.
+	def register(self, client):
+		client.meta.events.register('before-call', self.before_call)
+		client.meta.events.register('after-call', self.after_call)
+		client.meta.events.register('after-call-error', self.after_call_error)
+		if self.token_bucket:
+			client.meta.events.register('before-send', self.before_send)
+		if self.bullkit.settings.metrics_output:
+			self.bullkit.get_metrics().register(client)
+
+	# Work out whether a call can be memoized, and if so, the key to memoize it under.
+	def memo_key(self, model, params, context):
+		if (model.service_model.service_name, model.name) not in MEMOIZED_OPERATIONS:
+			return None
+		return json.dumps([model.service_model.service_name, model.name, context.get('client_region'), params.get('method'), params.get('url'), params.get('body')], sort_keys=True, default=str)
+
+	# Before a call is made, answer it from memory if we've already made it. If another thread is making it right now, wait for its answer.
+	def before_call(self, model, params, context, **kwargs):
+		key = self.memo_key(model, params, context)
+		if key is None:
+			return None
+		context['memo_key'] = key
+		with self.lock:
+			memoized_call = self.memoized_calls.get(key)
+			if memoized_call is None:
+				self.memoized_calls[key] = MemoizedCall()
+				return None
+		if memoized_call.done.wait(IN_FLIGHT_TIMEOUT) and memoized_call.response is not None:
+			self.bullkit.debug('Reusing the response to {} from earlier in this run.'.format(model.name))
+			context['memoized'] = True
+			http_response, parsed = memoized_call.response
+			return http_response, copy.deepcopy(parsed)
+		return None
+
+	# After a call is made, remember successful responses. Let anyone waiting for the call know it's done, so they can make it themselves if it failed.
+	def after_call(self, http_response, parsed, model, context, **kwargs):
+		key = context.get('memo_key')
+		if key is None or context.get('memoized'):
+			return
+		with self.lock:
+			memoized_call = self.memoized_calls.get(key)
+			if memoized_call is None or memoized_call.done.is_set():
+				return
+			if http_response.status_code < 300:
+				memoized_call.response = (http_response, copy.deepcopy(parsed))
+			else:
+				del self.memoized_calls[key]
+		memoized_call.done.set()
+
+	# If a call couldn't be made at all, let anyone waiting for it make it themselves.
+	def after_call_error(self, context, **kwargs):
+		key = context.get('memo_key')
+		if key is None or context.get('memoized'):
+			return
+		with self.lock:
+			memoized_call = self.memoized_calls.pop(key, None)
+		if memoized_call is not None:
+			memoized_call.done.set()
+
+	# Before each request is sent (including retries), wait for a token.
+	def before_send(self, **kwargs):
+		self.token_bucket.take()
+		return None
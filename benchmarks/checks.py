@@ -0,0 +1,136 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures how the checks perform against a fake AWS account, without a network: a synthetic account generated at the scale you ask for, or responses recorded from a real account. For each check, and for all of them together, it reports the wall time, the number of API calls and the peak memory used.
+#
+# Usage: python benchmarks/checks.py [--users N] [--buckets N] [--replay FILE] [--latency S] [--throttle-rate P] [-- aws-security-bot options]
+#        python benchmarks/checks.py --record FILE [-- aws-security-bot options]
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import awsclients
+import fakeaws
+import settings
+from bullkit import Bullkit
+
+# The checks we can run, and the options that turn them on.
+CHECK_OPTIONS = {
+	'mfa': ['--mfa'],
+	'publics3': ['--public-s3'],
+	'iamkeys': ['--iam-keys', '--iam-keys-warn-age', '80', '--iam-keys-expire-age', '90'],
+}
+
+# The name under which we run every check together, in the single pass over the account that the bot itself makes.
+ALL_CHECKS = 'all'
+
+# Make every client the checks create answer from our fake account (or record what the real one says). The check's own hooks, like memoization, come first, so only calls that would really be sent are counted.
+def install(backend):
+	original_register = awsclients.ClientFactory.register
+	def register(self, client):
+		original_register(self, client)
+		backend.install(client)
+	awsclients.ClientFactory.register = register
+
+# Run a check (or all of them) from scratch, with its own Bullkit and cache directory, sending its report nowhere. Returns how long it took, and the peak memory it used if we're tracing memory.
+def run_check(check_name, options, session):
+	import importlib
+	import rules
+	check_names = list(CHECK_OPTIONS) if check_name == ALL_CHECKS else [check_name]
+	checks = [importlib.import_module(name) for name in check_names]
+	with tempfile.TemporaryDirectory() as cache_dir:
+		bullkit = Bullkit(settings.load(['--no-slack', '--cache-dir', cache_dir] + [option for name in check_names for option in CHECK_OPTIONS[name]] + options), session=session)
+		if tracemalloc.is_tracing():
+			tracemalloc.clear_traces()
+			baseline = tracemalloc.get_traced_memory()[0]
+		started = time.perf_counter()
+		with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+			results = rules.scan(bullkit, [check.RULE for check in checks])
+			for check in checks:
+				if results[check.__name__] is not None:
+					bullkit.report(check, results[check.__name__])
+		wall_time = time.perf_counter() - started
+		peak_memory = tracemalloc.get_traced_memory()[1] - baseline if tracemalloc.is_tracing() else None
+	return wall_time, peak_memory
+
+def main():
+	parser = argparse.ArgumentParser(description='Measure the wall time, API calls and peak memory of each check against a fake AWS account.')
+	parser.add_argument('--checks', default=','.join(list(CHECK_OPTIONS) + [ALL_CHECKS]), help='A comma-separated list of the checks to run, where "{}" runs every check together in one pass. Defaults to each check on its own, then all of them together.'.format(ALL_CHECKS))
+	parser.add_argument('--users', type=int, default=10000, help='The number of IAM users in the synthetic account. Defaults to 10000.')
+	parser.add_argument('--buckets', type=int, default=5000, help='The number of S3 buckets in the synthetic account. Defaults to 5000.')
+	parser.add_argument('--seed', type=int, default=1, help='The seed the synthetic account and throttling are generated from. Defaults to 1.')
+	parser.add_argument('--replay', help='Answer calls with the responses recorded in this file, instead of a synthetic account.')
+	parser.add_argument('--record', help='Run the checks against the real account our credentials are for, and record its responses to this file for --replay.')
+	parser.add_argument('--latency', type=float, default=0, help='Seconds to add to each call. Defaults to 0.')
+	parser.add_argument('--jitter', type=float, default=0, help='A random number of seconds, up to this many, to add to or take from each call\'s latency. Defaults to 0.')
+	parser.add_argument('--throttle-rate', type=float, default=0, help='The chance (between 0 and 1) of each request being throttled. Throttled requests are retried by botocore, as they would be against AWS. Defaults to 0.')
+	parser.add_argument('--no-memory', action='store_true', help='Don\'t measure peak memory, which needs each check to be run a second time with tracemalloc.')
+	parser.add_argument('--output', help='Also write the results to this file as JSON, to compare runs.')
+	parser.add_argument('options', nargs='*', help='Options to run the checks with, after --, e.g. -- --credential-report --public-s3-workers 10')
+	args = parser.parse_args()
+
+	import boto3
+	if args.record:
+		backend = fakeaws.Recorder(args.record)
+		session = boto3.session.Session()
+	else:
+		account = fakeaws.RecordedAccount(args.replay) if args.replay else fakeaws.SyntheticAccount(args.users, args.buckets, args.seed)
+		backend = fakeaws.FakeAWS(account, latency=args.latency, jitter=args.jitter, throttle_rate=args.throttle_rate, seed=args.seed)
+		session = boto3.session.Session(aws_access_key_id='benchmark', aws_secret_access_key='benchmark', region_name='us-east-1')
+	install(backend)
+
+	results = {}
+	for check_name in args.checks.split(','):
+		if hasattr(backend, 'reset'):
+			backend.reset()
+		wall_time, peak_memory = run_check(check_name, args.options, session)
+		results[check_name] = {'wall time': wall_time}
+		if hasattr(backend, 'calls'):
+			results[check_name].update({'api calls': sum(backend.calls.values()), 'throttles': backend.throttles, 'calls by operation': dict(backend.calls)})
+
+		# Measure memory in a second run, since tracing slows everything down.
+		if not args.no_memory and not args.record:
+			tracemalloc.start()
+			results[check_name]['peak memory'] = run_check(check_name, args.options, session)[1]
+			tracemalloc.stop()
+
+	if args.record:
+		backend.close()
+		print('Recorded the responses to {}'.format(args.record))
+
+	source = 'recorded responses from {}'.format(args.replay) if args.replay else 'the real account' if args.record else 'a synthetic account of {} users and {} buckets'.format(args.users, args.buckets)
+	print('Checks against {}, with {:.3f}s latency and a {:.0%} throttle rate:'.format(source, args.latency, args.throttle_rate))
+	print('{:<12}{:>12}{:>12}{:>12}{:>16}'.format('check', 'wall time', 'api calls', 'throttles', 'peak memory'))
+	for check_name, result in results.items():
+		peak_memory = '{:.1f} MiB'.format(result['peak memory'] / 1048576.0) if 'peak memory' in result else '-'
+		print('{:<12}{:>11.2f}s{:>12}{:>12}{:>16}'.format(check_name, result['wall time'], result.get('api calls', '-'), result.get('throttles', '-'), peak_memory))
+		for operation, calls in sorted(result.get('calls by operation', {}).items()):
+			print('    {:<36}{:>8}'.format(operation, calls))
+
+	if args.output:
+		with open(args.output, 'w') as stream:
+			json.dump({'source': source, 'latency': args.latency, 'throttle rate': args.throttle_rate, 'options': args.options, 'checks': results}, stream, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Handles CloudTrail events against a synthetic AWS account, one at a time as EventBridge delivers them, and measures the API calls each one takes compared with a full scan. It fails if an event makes an account-wide listing call, or more calls than checking its user or bucket should take, since the point of handling events is not to scan the whole account.
+#
+# Usage: python benchmarks/events.py [--users N] [--buckets N] [--events N] [-- aws-security-bot options]
+
+import argparse
+import contextlib
+import os
+import random
+import statistics
+import sys
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import checks
+import fakeaws
+import settings
+
+# Calls that list or describe every user or bucket in the account, which an event should never need.
+ACCOUNT_WIDE_OPERATIONS = ('iam.GenerateCredentialReport', 'iam.GetCredentialReport', 'iam.ListUsers', 's3.ListBuckets')
+
+# The most calls an event should take: getting our account ID and the account's public access block, plus the most a user (3) or bucket (4) needs.
+MAX_CALLS_PER_EVENT = 6
+
+# Make an EventBridge event for a CloudTrail record of an event about a user or bucket.
+def make_event(event_name, resource_name):
+	import events
+	is_bucket = events.EVENT_CHECKS[event_name] == ('publics3',)
+	return {
+		'version': '0',
+		'source': 'aws.s3' if is_bucket else 'aws.iam',
+		'detail-type': 'AWS API Call via CloudTrail',
+		'detail': {
+			'eventVersion': '1.08',
+			'eventSource': 's3.amazonaws.com' if is_bucket else 'iam.amazonaws.com',
+			'eventName': event_name,
+			'requestParameters': {'bucketName' if is_bucket else 'userName': resource_name},
+			'recipientAccountId': fakeaws.SYNTHETIC_ACCOUNT_ID,
+		},
+	}
+
+# Handle an event (or run a full scan, if there's no event) from scratch, with its own Bullkit and cache directory, as a fresh Lambda invocation would, sending its report nowhere.
+def run(options, session, event=None):
+	from bullkit import Bullkit
+	import events
+	aws_security_bot = __import__('aws-security-bot')
+	with tempfile.TemporaryDirectory() as cache_dir:
+		bullkit = Bullkit(settings.load(['--no-slack', '--cache-dir', cache_dir] + [option for check_options in checks.CHECK_OPTIONS.values() for option in check_options] + options), session=session)
+		with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+			if event is None:
+				aws_security_bot.run_checks(bullkit, aws_security_bot.enabled_checks(bullkit.settings))
+			else:
+				events.handle(bullkit, event, aws_security_bot.enabled_checks(bullkit.settings))
+
+def main():
+	parser = argparse.ArgumentParser(description='Measure the API calls it takes to handle CloudTrail events against a synthetic AWS account, and check that no event scans the whole account.')
+	parser.add_argument('--users', type=int, default=10000, help='The number of IAM users in the synthetic account. Defaults to 10000.')
+	parser.add_argument('--buckets', type=int, default=5000, help='The number of S3 buckets in the synthetic account. Defaults to 5000.')
+	parser.add_argument('--seed', type=int, default=1, help='The seed the synthetic account and events are generated from. Defaults to 1.')
+	parser.add_argument('--events', type=int, default=200, help='The number of events to handle. Defaults to 200.')
+	parser.add_argument('options', nargs='*', help='Options for the checks, after --, e.g. -- --public-s3-workers 10')
+	args = parser.parse_args()
+
+	import events
+	account = fakeaws.SyntheticAccount(args.users, args.buckets, args.seed)
+	backend = fakeaws.FakeAWS(account, seed=args.seed)
+	checks.install(backend)
+	import boto3
+	session = boto3.session.Session(aws_access_key_id='benchmark', aws_secret_access_key='benchmark', region_name='us-east-1')
+
+	run(args.options, session)
+	scan_calls = sum(backend.calls.values())
+
+	# Handle events about random users and buckets, counting the calls each one makes.
+	randomizer = random.Random(args.seed)
+	user_names = [user['UserName'] for user in account.users]
+	bucket_names = [bucket['Name'] for bucket in account.buckets]
+	event_calls = []
+	calls_by_operation = Counter()
+	failures = []
+	for index in range(args.events):
+		event_name = randomizer.choice(sorted(events.EVENT_CHECKS))
+		resource_name = randomizer.choice(bucket_names if events.EVENT_CHECKS[event_name] == ('publics3',) else user_names)
+		backend.reset()
+		run(args.options, session, make_event(event_name, resource_name))
+		calls_by_operation.update(backend.calls)
+		event_calls.append(sum(backend.calls.values()))
+		account_wide = sorted([operation for operation in backend.calls if operation in ACCOUNT_WIDE_OPERATIONS])
+		if account_wide or event_calls[-1] > MAX_CALLS_PER_EVENT:
+			failures.append('{} for {} made {} calls{}'.format(event_name, resource_name, event_calls[-1], ', including {}'.format(', '.join(account_wide)) if account_wide else ''))
+
+	print('A full scan of {} users and {} buckets made {} calls.'.format(args.users, args.buckets, scan_calls))
+	print('Handling {} events made a median of {} calls each, and at most {}:'.format(args.events, statistics.median(event_calls), max(event_calls)))
+	for operation, count in sorted(calls_by_operation.items()):
+		print('    {:<38}{:>6}'.format(operation, count))
+	if failures:
+		sys.exit('Some events made calls they shouldn\'t have:\n{}'.format('\n'.join(failures)))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,318 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Fake AWS accounts for running the checks without a network. Requests made by botocore clients are answered instead of being sent, either from a synthetic account or from responses recorded from a real one, with optional latency and throttling.
+#
+# botocore's Stubber isn't used because it expects calls in a fixed order, which concurrent checks and workers don't make.
+
+import base64
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from xml.sax.saxutils import escape
+from botocore.awsrequest import AWSResponse, HeadersDict
+
+# The account ID of synthetic accounts.
+SYNTHETIC_ACCOUNT_ID = '123456789012'
+
+# The regions synthetic buckets live in. us-east-1 buckets have no location constraint.
+SYNTHETIC_REGIONS = ['us-east-1', 'us-west-2', 'eu-west-1', 'ap-southeast-2']
+
+# The ACLs synthetic buckets are given, and how likely each is.
+SYNTHETIC_ACLS = [('private', 0.80), ('public-read', 0.10), ('authenticated-read', 0.07), ('public-read-write', 0.03)]
+
+# How many users IAM returns in each page of ListUsers.
+LIST_USERS_PAGE_SIZE = 100
+
+# The header that tells us which of our answers a response is for.
+RESPONSE_ID_HEADER = 'x-benchmark-response-id'
+
+# The grantees S3 uses for the public.
+ALL_USERS_URI = 'http://acs.amazonaws.com/groups/global/AllUsers'
+AUTHENTICATED_USERS_URI = 'http://acs.amazonaws.com/groups/global/AuthenticatedUsers'
+
+# The body of a response in a service's wire format. Errors are written out in full, so botocore reads their codes itself, as are bucket locations, which botocore parses by hand. Other responses are left empty, and their contents handed over when they're parsed.
+def wire_body(protocol, operation_name, status_code, parsed):
+	if status_code >= 300:
+		code, message = escape(parsed['Error']['Code']), escape(parsed['Error'].get('Message', ''))
+		if protocol == 'query':
+			return '<ErrorResponse><Error><Type>Sender</Type><Code>{}</Code><Message>{}</Message></Error><RequestId>benchmark</RequestId></ErrorResponse>'.format(code, message).encode('utf-8')
+		if protocol == 'rest-xml':
+			return '<Error><Code>{}</Code><Message>{}</Message><RequestId>benchmark</RequestId></Error>'.format(code, message).encode('utf-8')
+		return json.dumps({'__type': parsed['Error']['Code'], 'message': parsed['Error'].get('Message', '')}).encode('utf-8')
+	if operation_name == 'GetBucketLocation':
+		return '<LocationConstraint xmlns="http://s3.amazonaws.com/doc/2006-03-01/">{}</LocationConstraint>'.format(escape(parsed['LocationConstraint'] or '')).encode('utf-8')
+	if protocol == 'query':
+		return '<{0}Response><{0}Result></{0}Result><ResponseMetadata><RequestId>benchmark</RequestId></ResponseMetadata></{0}Response>'.format(operation_name).encode('utf-8')
+	if protocol == 'rest-xml':
+		return b''
+	return b'{}'
+
+# Stands in for the body of an HTTP response that was never sent.
+class FakeRawResponse:
+	def __init__(self, content):
+		self.content = content
+
+	def stream(self, **kwargs):
+		yield self.content
+
+# Make an AWS error response.
+def error(status_code, code, message=''):
+	return status_code, {'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': status_code}}
+
+# A made up AWS account with IAM users and S3 buckets in assorted states, generated from a seed so it's the same every time.
+class SyntheticAccount:
+	def __init__(self, users=10000, buckets=5000, seed=1):
+		rng = random.Random(seed)
+		now = datetime.now(timezone.utc)
+
+		# Users, with and without passwords, MFA devices and access keys of various ages.
+		self.users = []
+		for index in range(users):
+			password = rng.random() < 0.7
+			mfa = password and rng.random() < 0.6
+			access_keys = []
+			for key_index in range(rng.choice([0, 1, 1, 1, 2])):
+				access_keys.append({'UserName': 'user{:05d}'.format(index), 'AccessKeyId': 'AKIA{:016d}'.format(index * 2 + key_index), 'Status': 'Active' if rng.random() < 0.85 else 'Inactive', 'CreateDate': now - timedelta(days=rng.uniform(0, 400))})
+			self.users.append({'UserName': 'user{:05d}'.format(index), 'CreateDate': now - timedelta(days=500), 'password': password, 'mfa': mfa, 'access_keys': access_keys})
+		self.users_by_name = {user['UserName']: user for user in self.users}
+
+		# Buckets in several regions, with assorted ACLs, public access blocks and policies.
+		self.buckets = []
+		for index in range(buckets):
+			acl = rng.random()
+			for acl_name, probability in SYNTHETIC_ACLS:
+				if acl < probability:
+					break
+				acl -= probability
+			policy = rng.random()
+			self.buckets.append({'Name': 'bucket-{:05d}'.format(index), 'CreationDate': now - timedelta(days=500), 'region': rng.choice(SYNTHETIC_REGIONS), 'acl': acl_name, 'blocked': rng.random() < 0.3, 'policy': None if policy < 0.8 else 'private' if policy < 0.95 else 'public'})
+		self.buckets_by_name = {bucket['Name']: bucket for bucket in self.buckets}
+
+	# Answer a call, returning its HTTP status and parsed response.
+	def respond(self, service_name, operation_name, params):
+		handler = getattr(self, '{}_{}'.format(service_name.replace('-', '_'), operation_name), None)
+		if handler is None:
+			return error(400, 'InvalidAction', 'The synthetic account doesn\'t support {}.{}'.format(service_name, operation_name))
+		return handler(params)
+
+	def sts_GetCallerIdentity(self, params):
+		return 200, {'Account': SYNTHETIC_ACCOUNT_ID, 'UserId': 'AIDABENCHMARK', 'Arn': 'arn:aws:iam::{}:user/benchmark'.format(SYNTHETIC_ACCOUNT_ID)}
+
+	def iam_ListUsers(self, params):
+		start = int(params.get('Marker', 0))
+		end = start + int(params.get('MaxItems', LIST_USERS_PAGE_SIZE))
+		response = {'Users': [{'UserName': user['UserName'], 'Path': '/', 'UserId': 'AIDA{}'.format(user['UserName']), 'Arn': 'arn:aws:iam::{}:user/{}'.format(SYNTHETIC_ACCOUNT_ID, user['UserName']), 'CreateDate': user['CreateDate']} for user in self.users[start:end]], 'IsTruncated': end < len(self.users)}
+		if response['IsTruncated']:
+			response['Marker'] = str(end)
+		return 200, response
+
+	def iam_ListMFADevices(self, params):
+		user = self.users_by_name.get(params['UserName'])
+		if user is None:
+			return error(404, 'NoSuchEntity')
+		return 200, {'MFADevices': [{'UserName': user['UserName'], 'SerialNumber': 'arn:aws:iam::{}:mfa/{}'.format(SYNTHETIC_ACCOUNT_ID, user['UserName']), 'EnableDate': user['CreateDate']}] if user['mfa'] else [], 'IsTruncated': False}
+
+	def iam_GetLoginProfile(self, params):
+		user = self.users_by_name.get(params['UserName'])
+		if user is None or not user['password']:
+			return error(404, 'NoSuchEntity', 'Login Profile for User {} cannot be found.'.format(params['UserName']))
+		return 200, {'LoginProfile': {'UserName': user['UserName'], 'CreateDate': user['CreateDate']}}
+
+	def iam_ListAccessKeys(self, params):
+		user = self.users_by_name.get(params['UserName'])
+		if user is None:
+			return error(404, 'NoSuchEntity')
+		return 200, {'AccessKeyMetadata': user['access_keys'], 'IsTruncated': False}
+
+	def iam_GenerateCredentialReport(self, params):
+		return 200, {'State': 'COMPLETE'}
+
+	def iam_GetCredentialReport(self, params):
+		def timestamp(value):
+			return value.strftime('%Y-%m-%dT%H:%M:%S+00:00') if value else 'N/A'
+		lines = ['user,arn,user_creation_time,password_enabled,password_last_used,password_last_changed,password_next_rotation,mfa_active,access_key_1_active,access_key_1_last_rotated,access_key_1_last_used_date,access_key_1_last_used_region,access_key_1_last_used_service,access_key_2_active,access_key_2_last_rotated,access_key_2_last_used_date,access_key_2_last_used_region,access_key_2_last_used_service,cert_1_active,cert_1_last_rotated,cert_2_active,cert_2_last_rotated']
+		lines.append('<root_account>,arn:aws:iam::{}:root,{},not_supported,N/A,not_supported,not_supported,true,false,N/A,N/A,N/A,N/A,false,N/A,N/A,N/A,N/A,false,N/A,false,N/A'.format(SYNTHETIC_ACCOUNT_ID, timestamp(self.users[0]['CreateDate'] if self.users else None)))
+		for user in self.users:
+			access_keys = (user['access_keys'] + [None, None])[:2]
+			cells = [user['UserName'], 'arn:aws:iam::{}:user/{}'.format(SYNTHETIC_ACCOUNT_ID, user['UserName']), timestamp(user['CreateDate']), str(user['password']).lower(), 'N/A', 'N/A', 'N/A', str(user['mfa']).lower()]
+			for access_key in access_keys:
+				cells.extend([str(bool(access_key) and access_key['Status'] == 'Active').lower(), timestamp(access_key['CreateDate'] if access_key else None), 'N/A', 'N/A', 'N/A'])
+			cells.extend(['false', 'N/A', 'false', 'N/A'])
+			lines.append(','.join(cells))
+		return 200, {'Content': '\n'.join(lines).encode('utf-8'), 'ReportFormat': 'text/csv', 'GeneratedTime': datetime.now(timezone.utc)}
+
+	def s3_ListBuckets(self, params):
+		return 200, {'Buckets': [{'Name': bucket['Name'], 'CreationDate': bucket['CreationDate']} for bucket in self.buckets], 'Owner': {'ID': 'benchmark'}}
+
+	def s3_GetBucketLocation(self, params):
+		region = self.buckets_by_name[params['Bucket']]['region']
+		return 200, {'LocationConstraint': None if region == 'us-east-1' else region}
+
+	def s3control_GetPublicAccessBlock(self, params):
+		return error(404, 'NoSuchPublicAccessBlockConfiguration')
+
+	def s3_GetPublicAccessBlock(self, params):
+		if not self.buckets_by_name[params['Bucket']]['blocked']:
+			return error(404, 'NoSuchPublicAccessBlockConfiguration')
+		return 200, {'PublicAccessBlockConfiguration': {'BlockPublicAcls': True, 'IgnorePublicAcls': True, 'BlockPublicPolicy': True, 'RestrictPublicBuckets': True}}
+
+	def s3_GetBucketPolicyStatus(self, params):
+		policy = self.buckets_by_name[params['Bucket']]['policy']
+		if policy is None:
+			return error(404, 'NoSuchBucketPolicy')
+		return 200, {'PolicyStatus': {'IsPublic': policy == 'public'}}
+
+	def s3_GetBucketAcl(self, params):
+		acl = self.buckets_by_name[params['Bucket']]['acl']
+		grants = [{'Grantee': {'Type': 'CanonicalUser', 'ID': 'benchmark'}, 'Permission': 'FULL_CONTROL'}]
+		if acl in ('public-read', 'public-read-write'):
+			grants.append({'Grantee': {'Type': 'Group', 'URI': ALL_USERS_URI}, 'Permission': 'READ'})
+		if acl == 'public-read-write':
+			grants.append({'Grantee': {'Type': 'Group', 'URI': ALL_USERS_URI}, 'Permission': 'WRITE'})
+		if acl == 'authenticated-read':
+			grants.append({'Grantee': {'Type': 'Group', 'URI': AUTHENTICATED_USERS_URI}, 'Permission': 'READ'})
+		return 200, {'Owner': {'ID': 'benchmark'}, 'Grants': grants}
+
+# Convert responses to and from JSON, keeping their dates and bytes.
+def encode(value):
+	if isinstance(value, datetime):
+		return {'__datetime__': value.isoformat()}
+	if isinstance(value, bytes):
+		return {'__bytes__': base64.b64encode(value).decode('ascii')}
+	raise TypeError('Can\'t encode {!r}'.format(value))
+
+def decode(value):
+	if '__datetime__' in value:
+		return datetime.fromisoformat(value['__datetime__'])
+	if '__bytes__' in value:
+		return base64.b64decode(value['__bytes__'])
+	return value
+
+# The key a call's response is recorded under.
+def call_key(service_name, operation_name, params):
+	return json.dumps([service_name, operation_name, params], sort_keys=True, default=encode)
+
+# Answers calls with responses recorded from a real account. If a call was recorded several times (e.g. while waiting for the credential report), the responses are replayed in order, repeating the last one.
+class RecordedAccount:
+	def __init__(self, path):
+		self.lock = threading.Lock()
+		self.responses = {}
+		with open(path, 'r') as stream:
+			for line in stream:
+				call = json.loads(line, object_hook=decode)
+				self.responses.setdefault(call_key(call['service'], call['operation'], call['params']), []).append((call['status'], call['response']))
+
+	def respond(self, service_name, operation_name, params):
+		with self.lock:
+			responses = self.responses.get(call_key(service_name, operation_name, params))
+			if not responses:
+				return error(400, 'NotRecorded', 'No response to {}.{} was recorded for these parameters.'.format(service_name, operation_name))
+			return responses.pop(0) if len(responses) > 1 else responses[0]
+
+# Records the responses to calls made against a real account, as JSON lines that RecordedAccount can replay.
+class Recorder:
+	def __init__(self, path):
+		self.lock = threading.Lock()
+		self.stream = open(path, 'w')
+
+	def install(self, client):
+		client.meta.events.register('before-parameter-build', remember_params)
+		client.meta.events.register('after-call', self.after_call)
+
+	def after_call(self, http_response, parsed, model, context, **kwargs):
+		if model.has_streaming_output or 'benchmark_params' not in context:
+			return
+		line = json.dumps({'service': model.service_model.service_name, 'operation': model.name, 'params': context['benchmark_params'], 'status': http_response.status_code, 'response': parsed}, sort_keys=True, default=encode)
+		with self.lock:
+			self.stream.write('{}\n'.format(line))
+
+	def close(self):
+		self.stream.close()
+
+# Keep a call's parameters, as the caller gave them, for the handlers that run later.
+def remember_params(params, context, **kwargs):
+	context['benchmark_params'] = json.loads(json.dumps(params, default=encode), object_hook=decode)
+
+# Answers the requests made by botocore clients from a fake account, without sending them. It can add latency to each request, and throttle requests at random. Requests are answered just before they'd be sent, so everything else botocore does with them still happens: throttled requests go through the same retries, token bucket and metrics as they would against AWS. It counts the calls it answers, and how many of their requests it throttled.
+class FakeAWS:
+	def __init__(self, account, latency=0, jitter=0, throttle_rate=0, seed=1):
+		self.account = account
+		self.latency = latency
+		self.jitter = jitter
+		self.throttle_rate = throttle_rate
+		self.rng = random.Random(seed)
+		self.lock = threading.Lock()
+		self.responses = {}
+		self.next_response = 0
+		self.reset()
+
+	# Forget the calls counted so far.
+	def reset(self):
+		with self.lock:
+			self.calls = Counter()
+			self.throttles = 0
+
+	def install(self, client):
+		client.meta.events.register('before-parameter-build', remember_params)
+		client.meta.events.register('before-call', self.before_call)
+		client.meta.events.register('before-send', self.before_send)
+		client.meta.events.register('before-parse', self.before_parse)
+
+	# Remember what a call is, for when it's sent. Calls answered from memory are never sent, so they aren't counted.
+	def before_call(self, model, context, **kwargs):
+		context['benchmark_operation'] = (model.service_model.service_name, model.name)
+		context['benchmark_protocol'] = model.service_model.resolved_protocol
+
+	# Answer a request instead of sending it. botocore can only parse a response in the service's wire format, so the body we send back is as small as wire_body can make it, and the rest of the answer is handed over when it's parsed.
+	def before_send(self, request, **kwargs):
+		if 'benchmark_operation' not in request.context:
+			return None
+		service_name, operation_name = request.context['benchmark_operation']
+		if self.latency or self.jitter:
+			time.sleep(max(0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+		# Count each call once, however many times it's retried.
+		with self.lock:
+			if not request.context.get('benchmark_counted'):
+				request.context['benchmark_counted'] = True
+				self.calls['{}.{}'.format(service_name, operation_name)] += 1
+			throttled = self.rng.random() < self.throttle_rate
+			if throttled:
+				self.throttles += 1
+		if throttled:
+			status_code, parsed = error(400, 'Throttling', 'Rate exceeded')
+		else:
+			status_code, parsed = self.account.respond(service_name, operation_name, request.context.get('benchmark_params', {}))
+		headers = HeadersDict({'x-amzn-requestid': 'benchmark'})
+		if status_code < 300:
+			with self.lock:
+				self.next_response += 1
+				headers[RESPONSE_ID_HEADER] = str(self.next_response)
+				self.responses[headers[RESPONSE_ID_HEADER]] = parsed
+		return AWSResponse(request.url, status_code, headers, FakeRawResponse(wire_body(request.context['benchmark_protocol'], operation_name, status_code, parsed)))
+
+	# Hand over the contents of a successful response.
+	def before_parse(self, response_dict, customized_response_dict, **kwargs):
+		response_id = response_dict['headers'].pop(RESPONSE_ID_HEADER, None)
+		if response_id is None:
+			return
+		with self.lock:
+			parsed = self.responses.pop(response_id)
+		customized_response_dict.update({key: value for key, value in parsed.items() if key != 'ResponseMetadata'})
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs the --serve inventory server against a synthetic AWS account, and measures how long it takes to build its inventory and to answer queries over HTTP. With --keep-serving, it carries on answering queries, so you can try it with curl.
+#
+# Usage: python benchmarks/server.py [--users N] [--buckets N] [--queries N] [--keep-serving] [-- aws-security-bot options]
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import checks
+import fakeaws
+import server
+import settings
+
+# Make a query, returning the HTTP status and the result.
+def query(base_url, path, data=None):
+	try:
+		with urllib.request.urlopen(base_url + path, data=data) as response:
+			return response.status, json.loads(response.read().decode('utf-8'))
+	except urllib.error.HTTPError as exc:
+		return exc.code, json.loads(exc.read().decode('utf-8'))
+
+def main():
+	parser = argparse.ArgumentParser(description='Measure how quickly the --serve inventory server builds its inventory of a synthetic AWS account and answers queries about it.')
+	parser.add_argument('--users', type=int, default=10000, help='The number of IAM users in the synthetic account. Defaults to 10000.')
+	parser.add_argument('--buckets', type=int, default=5000, help='The number of S3 buckets in the synthetic account. Defaults to 5000.')
+	parser.add_argument('--seed', type=int, default=1, help='The seed the synthetic account is generated from. Defaults to 1.')
+	parser.add_argument('--queries', type=int, default=200, help='The number of queries of each kind to time. Defaults to 200.')
+	parser.add_argument('--keep-serving', action='store_true', help='Carry on answering queries once the benchmark is done, until interrupted.')
+	parser.add_argument('options', nargs='*', help='Options to run the server with, after --, e.g. -- --serve-port 8080 --public-s3-workers 10')
+	args = parser.parse_args()
+
+	account = fakeaws.SyntheticAccount(args.users, args.buckets, args.seed)
+	checks.install(fakeaws.FakeAWS(account, seed=args.seed))
+	import boto3
+	session = boto3.session.Session(aws_access_key_id='benchmark', aws_secret_access_key='benchmark', region_name='us-east-1')
+
+	inventory_server = server.InventoryServer(settings.load(['--no-slack', '--serve', '--serve-port', '0', '--iam-keys-expire-age', '90'] + args.options), session=session)
+	started = time.perf_counter()
+	inventory_server.refresh()
+	print('Built an inventory of {} users and {} buckets in {:.2f}s.'.format(args.users, args.buckets, time.perf_counter() - started))
+
+	httpd = server.http_server(inventory_server)
+	threading.Thread(target=httpd.serve_forever, daemon=True).start()
+	base_url = 'http://{}:{}'.format(*httpd.server_address[:2])
+
+	# Time each kind of query against random users and buckets.
+	randomizer = random.Random(args.seed)
+	user_names = [user['UserName'] for user in account.users]
+	bucket_names = [bucket['Name'] for bucket in account.buckets]
+	kinds = {
+		'is bucket X public': lambda: query(base_url, '/buckets/{}'.format(urllib.parse.quote(randomizer.choice(bucket_names)))),
+		'keys expiring this month': lambda: query(base_url, '/users/{}/keys?expiring=month'.format(urllib.parse.quote(randomizer.choice(user_names)))),
+		'users without MFA': lambda: query(base_url, '/users?mfa=false'),
+		'slash command': lambda: query(base_url, '/slack', urllib.parse.urlencode({'text': 'bucket {}'.format(randomizer.choice(bucket_names))}).encode('utf-8')),
+	}
+	print('Query latency over {} queries of each kind (milliseconds):'.format(args.queries))
+	print('{:<28}{:>10}{:>10}{:>10}'.format('', 'median', 'p99', 'max'))
+	for kind, make_query in kinds.items():
+		latencies = []
+		for attempt in range(args.queries):
+			started = time.perf_counter()
+			status, result = make_query()
+			latencies.append((time.perf_counter() - started) * 1000)
+			if status != 200:
+				sys.exit('{} failed with HTTP {}: {}'.format(kind, status, result))
+		latencies.sort()
+		print('{:<28}{:>10.2f}{:>10.2f}{:>10.2f}'.format(kind, statistics.median(latencies), latencies[max(0, -(-len(latencies) * 99 // 100) - 1)], latencies[-1]))
+
+	if args.keep_serving:
+		print('Answering queries on {}/ until interrupted, e.g. curl {}/buckets/{}'.format(base_url, base_url, bucket_names[0]))
+		threading.Thread(target=inventory_server.refresh_forever, daemon=True).start()
+		try:
+			while True:
+				time.sleep(60)
+		except KeyboardInterrupt:
+			pass
+	httpd.shutdown()
+
+if __name__ == '__main__':
+	main()
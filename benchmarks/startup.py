@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures how long AWS Security Bot takes to start, as a Lambda cold start would: how long importing it takes, and how long it takes to get from a fresh process to its first AWS API call. Each run is a new Python process, and the first API call is stopped before it's sent, so no AWS account is needed.
+#
+# Usage: python benchmarks/startup.py [--runs N] [--imports N] [-- aws-security-bot options]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# The directory that holds aws-security-bot.py.
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The options to run aws-security-bot with if we're not given any.
+DEFAULT_OPTIONS = ['--no-slack', '--mfa']
+
+# Run in a fresh process: import aws-security-bot, then run it until its first API call, and print how long each took.
+def child(options):
+	started = time.time()
+	sys.path.insert(0, PACKAGE_DIR)
+	import importlib
+	aws_security_bot = importlib.import_module('aws-security-bot')
+	imported = time.time()
+
+	# Stop at the first request any of the bot's clients is about to send.
+	import bullkit
+	def first_api_call(**kwargs):
+		sys.stdout.write('{}\n'.format(json.dumps({'imported': imported - started, 'first call': time.time() - imported, 'first call at': time.time()})))
+		sys.stdout.flush()
+		os._exit(0)
+	original_client = bullkit.Bullkit.client
+	def client(self, service_name, **kwargs):
+		aws_client = original_client(self, service_name, **kwargs)
+		aws_client.meta.events.register('before-send', first_api_call, unique_id='startup-benchmark')
+		return aws_client
+	bullkit.Bullkit.client = client
+
+	sys.argv = ['aws-security-bot'] + options
+	aws_security_bot.main()
+	sys.stderr.write('aws-security-bot finished without making an API call.\n')
+	sys.exit(1)
+
+# Run aws-security-bot in a fresh process, and return how long it took to start and to make its first API call.
+def measure(options, cache_dir):
+	env = dict(os.environ, AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark', AWS_DEFAULT_REGION='us-east-1', CACHE_DIR=cache_dir)
+	env.pop('AWS_PROFILE', None)
+	spawned = time.time()
+	output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', '--'] + options, env=env, stdout=subprocess.PIPE, check=True).stdout
+	timings = json.loads(output.decode('utf-8'))
+	timings['process to first call'] = timings.pop('first call at') - spawned
+	return timings
+
+# Find the modules that take longest to import, using Python's -X importtime.
+def slowest_imports(count):
+	stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import importlib, sys; sys.path.insert(0, {!r}); importlib.import_module("aws-security-bot")'.format(PACKAGE_DIR)], stderr=subprocess.PIPE, check=True).stderr
+	imports = []
+	for line in stderr.decode('utf-8').splitlines():
+		if line.startswith('import time:') and '|' in line and 'cumulative' not in line:
+			self_us, cumulative_us, module = line[len('import time:'):].split('|')
+			imports.append((int(cumulative_us), module.rstrip()))
+	return sorted(imports, reverse=True)[:count]
+
+def main():
+	parser = argparse.ArgumentParser(description='Measure the import time and time to first API call of AWS Security Bot.')
+	parser.add_argument('--runs', type=int, default=10, help='The number of fresh processes to measure. Defaults to 10.')
+	parser.add_argument('--imports', type=int, default=15, help='The number of slowest imports to list. Defaults to 15.')
+	parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+	parser.add_argument('options', nargs='*', help='Options to run aws-security-bot with, after --. Defaults to: {}'.format(' '.join(DEFAULT_OPTIONS)))
+	args = parser.parse_args()
+	options = args.options or DEFAULT_OPTIONS
+
+	if args.child:
+		child(options)
+		return
+
+	with tempfile.TemporaryDirectory() as cache_dir:
+		runs = [measure(options, cache_dir) for run in range(args.runs)]
+
+	print('Startup of aws-security-bot {} over {} runs (seconds):'.format(' '.join(options), args.runs))
+	print('{:<24}{:>10}{:>10}{:>10}'.format('', 'min', 'median', 'max'))
+	for timing in ('imported', 'first call', 'process to first call'):
+		values = [run[timing] for run in runs]
+		label = {'imported': 'import', 'first call': 'import to first call', 'process to first call': 'process to first call'}[timing]
+		print('{:<24}{:>10.3f}{:>10.3f}{:>10.3f}'.format(label, min(values), statistics.median(values), max(values)))
+
+	if args.imports:
+		print('\nSlowest imports (cumulative milliseconds):')
+		for cumulative_us, module in slowest_imports(args.imports):
+			print('{:>10.1f}  {}'.format(cumulative_us / 1000.0, module))
+
+if __name__ == '__main__':
+	main()
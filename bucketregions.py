@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+
+# GetBucketLocation returns no location for us-east-1, and the legacy name 'EU' for eu-west-1.
+LEGACY_LOCATIONS = {None: 'us-east-1', '': 'us-east-1', 'EU': 'eu-west-1'}
+
+# Keeps track of which region each S3 bucket lives in, and a pool of S3 clients (one per region) to talk to them without being redirected.
+class BucketRegions:
+	def __init__(self, bullkit, account_id, max_pool_connections):
+		self.bullkit = bullkit
+		self.max_pool_connections = max_pool_connections
+		self.lock = threading.Lock()
+		self.clients = {}
+		cache_dir = bullkit.get_cache_dir()
+		self.path = os.path.join(cache_dir, 'bucket-regions-{}.json'.format(account_id)) if cache_dir else None
+
+		# Load the index of bucket regions saved by previous runs.
+		self.index = {}
+		if self.path:
+			try:
+				with open(self.path, 'r') as stream:
+					self.index = json.load(stream)
+				self.bullkit.debug('Loaded the regions of {} buckets from {}'.format(len(self.index), self.path))
+			except (IOError, ValueError):
+				self.bullkit.debug('No saved bucket regions found at {}'.format(self.path))
+
+	# Get the S3 client for a region, creating it if we haven't already.
+	def client(self, region):
+		with self.lock:
+			if region not in self.clients:
+				self.bullkit.debug('Creating an S3 client for {}...'.format(region))
+				self.clients[region] = self.bullkit.client('s3', region_name=region, max_pool_connections=self.max_pool_connections)
+			return self.clients[region]
+
+	# Forget the buckets that no longer exist, so the index doesn't grow forever.
+	def prune(self, bucket_names):
+		with self.lock:
+			self.index = {bucket_name: self.index[bucket_name] for bucket_name in bucket_names if bucket_name in self.index}
+
+	# Get the region of a bucket, only asking S3 if it's a bucket we haven't seen before.
+	def region(self, bucket_name):
+		with self.lock:
+			region = self.index.get(bucket_name)
+		if region is None:
+			location = self.client('us-east-1').get_bucket_location(Bucket=bucket_name).get('LocationConstraint')
+			region = LEGACY_LOCATIONS.get(location, location)
+			self.bullkit.debug('{} is in {}'.format(bucket_name, region))
+			with self.lock:
+				self.index[bucket_name] = region
+		return region
+
+	# Get the S3 client for the region a bucket lives in. If a bucket has been recreated in another region since we indexed it, botocore's redirect handling still gets the request there.
+	def client_for(self, bucket_name):
+		return self.client(self.region(bucket_name))
+
+	# Save the index for the next run, if we have somewhere safe to keep it.
+	def save(self):
+		if not self.path:
+			return
+		try:
+			with open(self.path, 'w') as stream:
+				json.dump(self.index, stream)
+		except (IOError, OSError) as exc:
+			self.bullkit.debug('Couldn\'t save the bucket regions to {}: {}'.format(self.path, exc))
@@ -15,47 +15,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import os
 import sys
-from slackclient import SlackClient
+import threading
+import time
+
+# How many seconds to leave, once we've stopped sending Slack messages, to write out our metrics before Lambda stops us.
+FINISH_SECONDS = 2
+
+# What we add to a report when its check ran out of time.
+INCOMPLETE_MESSAGE = '_I ran out of time before I could finish this check, so these results are incomplete._'
 
 class Bullkit:
-	def __init__(self, commandargs):
-		self.commandargs = commandargs
-
-		# If we're supposed to talk to Slack...
-		if not self.commandargs.parse_args().no_slack:
-			# ...fail if the API token hasn't been provided.
-			if not self.commandargs.parse_args().slack_token:
-				self.abort('--slack-token must be specified if you\'re not suppressing Slack output with --no-slack')
-
-			# ...fail if we've not been told what Slack channel to use for MFA results.
-			if self.commandargs.parse_args().mfa:
-				if not self.commandargs.parse_args().mfa_channel:
-					self.abort('--mfa-channel must be specified if you\'re using --mfa without --no-slack')
-
-			# ...fail if we've not been told what Slack channel to use for public S3 results.
-			if self.commandargs.parse_args().public_s3:
-				if not self.commandargs.parse_args().public_s3_channel:
-					self.abort('--public-s3-channel must be specified if you\'re using --public-s3 without --no-slack')
-
-			# ...fail if we've not been told what Slack channel to use for IAM access key results.
-			if self.commandargs.parse_args().iam_keys:
-				if not self.commandargs.parse_args().iam_keys_channel:
-					self.abort('--iam-keys-channel must be specified if you\'re using --iam-keys without --no-slack')
-
-		# If we're supposed to check IAM keys...
-		if self.commandargs.parse_args().iam_keys:
-			# ...fail if a key warning age hasn't been provided.
-			if not self.commandargs.parse_args().iam_keys_warn_age:
-				self.abort('--iam-keys-warn-age must be specified if you\'re checking for expired IAM access keys with --iam-keys')
-
-			# ...fail if a maximum key age hasn't been provided.
-			if not self.commandargs.parse_args().iam_keys_expire_age:
-				self.abort('--iam-keys-expire-age must be specified if you\'re checking for expired IAM access keys with --iam-keys')
-
-			# ...fail if the maximum key age isn't greater than the key warning age.
-			if int(self.commandargs.parse_args().iam_keys_warn_age) >= int(self.commandargs.parse_args().iam_keys_expire_age):
-				self.abort('--iam-keys-expire-age must be greater than --iam-keys-warn-age')
+	def __init__(self, settings, session=None, account_id=None):
+		# Our options, parsed and validated once by settings.load().
+		self.settings = settings
+
+		# The AWS session to check, which is our own credentials unless we've assumed a role in another account.
+		if session is None:
+			import boto3
+			session = boto3.session.Session()
+		self.session = session
+		self.account_id = account_id
+
+		# The time by which we must stop starting new work, if we have a deadline, the time we'll be stopped at, and the checks that ran out of time because of the deadline.
+		self.deadline = None
+		self.end = None
+		self.cut_short = set()
+		self.lock = threading.Lock()
+		self.credential_report_lock = threading.Lock()
+		self.slack_directory_lock = threading.Lock()
 
 	# Function for outputting text to stderr.
 	def stderr(self, message):
@@ -63,26 +53,249 @@ class Bullkit:
 
 	# Function for outputting debug messages only if the "verbose" option is enabled.
 	def debug(self, message):
-		if self.commandargs.parse_args().v:
+		if self.settings.v:
 			self.stderr(message)
 
-	# Function for outputting fatal error messages.
-	def abort(self, message):
-		self.stderr(message)
-		quit()
+	# Function for getting the directory in which to keep data for later runs, creating it (readable only by us) if it doesn't exist. Since we load what's in it, it must belong to us and only be writable by us, or other local users could plant files there. Returns None if it isn't safe to use.
+	def get_cache_dir(self):
+		cache_dir = self.settings.cache_dir
+		try:
+			os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+			status = os.stat(cache_dir)
+		except OSError as exc:
+			self.debug('Couldn\'t create the cache directory {}: {}'.format(cache_dir, exc))
+			return None
+		if status.st_uid != os.getuid() or status.st_mode & 0o022:
+			self.stderr('Not using the cache directory {}, because it belongs to another user or others can write to it.'.format(cache_dir))
+			return None
+		return cache_dir
+
+	# Function for setting our deadline, given how many seconds we have left to run (e.g. before Lambda kills us). We leave a margin to report whatever we've found by then.
+	def set_deadline(self, seconds_remaining):
+		self.end = time.time() + seconds_remaining
+		self.deadline = self.end - self.settings.deadline_margin
+		self.debug('We have {:.1f} seconds until our deadline.'.format(self.deadline - time.time()))
+
+	# Function for checking whether we've passed our deadline.
+	def past_deadline(self):
+		return self.deadline is not None and time.time() >= self.deadline
+
+	# Function for checks to call before each unit of work. If we've passed our deadline, it notes that the check was cut short and returns True, meaning the check should stop and return what it's found so far.
+	def out_of_time(self, check_name):
+		if not self.past_deadline():
+			return False
+		with self.lock:
+			if check_name not in self.cut_short:
+				self.debug('Out of time, so we\'re cutting {} short.'.format(check_name))
+				self.cut_short.add(check_name)
+		return True
+
+	# Function for checking whether a check ran out of time.
+	def was_cut_short(self, check_name):
+		with self.lock:
+			return check_name in self.cut_short
+
+	# Function for making a Bullkit that checks another account using the given session. It shares our deadline and checkpoint store.
+	def for_account(self, account_id, session):
+		account_bullkit = Bullkit(self.settings, session=session, account_id=account_id)
+		account_bullkit.deadline = self.deadline
+		account_bullkit.end = self.end
+		if self.settings.checkpoint_store:
+			account_bullkit.checkpoint_store = self.get_checkpoint_store()
+		if self.settings.metrics_output:
+			account_bullkit.metrics = self.get_metrics()
+		return account_bullkit
+
+	# Function for getting the metrics we record about each check, if we've been asked for them with --metrics-output.
+	def get_metrics(self):
+		with self.lock:
+			try:
+				self.metrics
+			except AttributeError:
+				import metrics
+				self.metrics = metrics.Metrics(self)
+			return self.metrics
+
+	# Function for running a check (or part of one), so the AWS and Slack calls made by this thread and (unless timed is False) the time it takes are counted against the check in our metrics.
+	@contextlib.contextmanager
+	def checking(self, check_name, timed=True):
+		if not self.settings.metrics_output:
+			yield
+			return
+		with self.get_metrics().check(check_name, timed):
+			yield
+
+	# Function for counting time spent on a check that wasn't spent in a checking() block against it in our metrics.
+	def record_wall_time(self, check_name, seconds):
+		if self.settings.metrics_output:
+			self.get_metrics().add_wall_time(check_name, seconds)
+
+	# Function for writing our metrics to --metrics-output, if we recorded any. Call it after flush_slack_messages(), so they include every Slack call.
+	def close_metrics(self):
+		with self.lock:
+			try:
+				metrics = self.metrics
+			except AttributeError:
+				return
+			del self.metrics
+		metrics.close()
+
+	# Function for getting the factory that makes our boto3 clients and resources, creating it if we haven't already.
+	def get_client_factory(self):
+		with self.lock:
+			try:
+				self.client_factory
+			except AttributeError:
+				import awsclients
+				self.client_factory = awsclients.ClientFactory(self, self.session)
+			return self.client_factory
+
+	# Functions for getting boto3 clients and resources for our session. They're shared by every check, and identical account-wide read-only calls made through them are only sent to AWS once per run.
+	def client(self, service_name, **kwargs):
+		return self.get_client_factory().client(service_name, **kwargs)
 
+	def resource(self, service_name, **kwargs):
+		return self.get_client_factory().resource(service_name, **kwargs)
+
+	# Function for getting the dispatcher that sends our calls to Slack, starting it if we haven't already.
+	def get_slack_dispatcher(self):
+		with self.lock:
+			try:
+				self.slack_dispatcher
+			except AttributeError:
+				self.debug('Initializing Slack dispatcher...')
+				import slackdispatcher
+				self.slack_dispatcher = slackdispatcher.SlackDispatcher(self, self.settings.slack_token, self.settings.slack_api_url, self.settings.slack_workers)
+			return self.slack_dispatcher
+
+	# Function for queueing a Slack message. It's sent in the background, so call flush_slack_messages() before exiting.
 	def send_slack_message(self, channel, my_name, my_emoji, message):
-		# Connect to Slack if we haven't already.
-		try:
-			self.slack
-		except AttributeError:
-			self.debug('Initializing Slack object...')
-			self.slack = SlackClient(self.commandargs.parse_args().slack_token)
-
-		# Send the message.
-		slackresult = self.slack.api_call('chat.postMessage', channel=channel, username=my_name, icon_emoji=my_emoji, text=message)
-
-		# Make sure the post was successful.
-		if slackresult['ok'] is not True:
-			self.abort('Posting to Slack was unsuccessful. Slack said:\n{}'.format(slackresult))
-		self.debug('Posting to Slack was successfull.')
+		self.get_slack_dispatcher().call('chat.postMessage', channel=channel, username=my_name, icon_emoji=my_emoji, text=message)
+
+	# Function for getting the map of AWS users to Slack users from users.yml, which is loaded once per run. Returns None if it can't be loaded.
+	def get_slack_users(self):
+		with self.slack_directory_lock:
+			try:
+				self.slack_users
+			except AttributeError:
+				import slackdirectory
+				self.slack_users = slackdirectory.load_users(self)
+			return self.slack_users
+
+	# Function for working out which channel to use to send a Slack user a direct message, which is their user ID. The user may be given by ID, email address, name or display name.
+	def slack_dm_channel(self, slack_user):
+		with self.slack_directory_lock:
+			try:
+				self.slack_directory
+			except AttributeError:
+				import slackdirectory
+				self.slack_directory = slackdirectory.load_directory(self)
+
+		slack_user = str(slack_user).lstrip('@')
+		if slack_user.lower() not in self.slack_directory:
+			self.debug('Couldn\'t find {} in the Slack directory, so we\'ll message them by name.'.format(slack_user))
+			return '@{}'.format(slack_user)
+		user_id = self.slack_directory[slack_user.lower()]
+		# Don't guess between several people who go by the same name, or we might send someone else's security alerts to the wrong person.
+		if user_id is None:
+			self.stderr('{} could be any of several Slack users, so we\'ll message them by name.'.format(slack_user))
+			return '@{}'.format(slack_user)
+		return user_id
+
+	# Function for waiting until every queued Slack message has been sent, then reporting how it went. If we're running in Lambda, we stop waiting in time to write out our metrics before we're stopped, and count the messages we didn't get to.
+	def flush_slack_messages(self):
+		with self.lock:
+			try:
+				slack_dispatcher = self.slack_dispatcher
+			except AttributeError:
+				return
+			del self.slack_dispatcher
+		stats = slack_dispatcher.close(None if self.end is None else self.end - FINISH_SECONDS)
+		self.stderr('Slack delivery: {} sent, {} retried, {} rate limited, {} failed, {} unsent because we ran out of time.'.format(stats['sent'], stats['retried'], stats['rate limited'], stats['failed'], stats['unsent']))
+
+	# Function for getting the IAM credential report, which is fetched once and shared by every check. Returns None if checks should make per-user API calls instead.
+	def get_credential_report(self):
+		# Load the report if we haven't already. Checks may run concurrently, so make sure only one of them loads it.
+		with self.credential_report_lock:
+			try:
+				self.credential_report
+			except AttributeError:
+				if self.settings.credential_report:
+					import credentialreport
+					self.credential_report = credentialreport.load(self)
+				else:
+					self.credential_report = None
+			return self.credential_report
+
+	# Function for getting the store in which sharded scans keep their checkpoints.
+	def get_checkpoint_store(self):
+		with self.lock:
+			try:
+				self.checkpoint_store
+			except AttributeError:
+				import checkpoint
+				self.checkpoint_store = checkpoint.checkpoint_store(self)
+			return self.checkpoint_store
+
+	# Function for getting the store in which we keep the findings of previous runs.
+	def get_finding_store(self):
+		with self.lock:
+			try:
+				self.finding_store
+			except AttributeError:
+				import findingstore
+				self.finding_store = findingstore.finding_store(self)
+			return self.finding_store
+
+	# Function for saving the findings store, if we used it.
+	def close_finding_store(self):
+		with self.lock:
+			try:
+				finding_store = self.finding_store
+			except AttributeError:
+				return
+			del self.finding_store
+		finding_store.close()
+
+	# Function for getting the pipeline that passes findings and reports to our --sinks, e.g. Slack and --findings-output.
+	def get_finding_pipeline(self):
+		with self.lock:
+			try:
+				self.finding_pipeline
+			except AttributeError:
+				import sinks
+				self.finding_pipeline = sinks.FindingPipeline(self)
+			return self.finding_pipeline
+
+	# Function for closing the findings pipeline, if we used it.
+	def close_finding_pipeline(self):
+		with self.lock:
+			try:
+				finding_pipeline = self.finding_pipeline
+			except AttributeError:
+				return
+			del self.finding_pipeline
+		finding_pipeline.close()
+
+	# Function for telling a check's channel which AWS users we couldn't message directly because they aren't in users.yml. They're listed in one report, rather than a message each, which would take a second per user to post.
+	def report_unknown_slack_users(self, channel, iam_user_names):
+		if not iam_user_names:
+			return
+		import sinks
+		self.post_report(channel, 'AWS users missing from users.yml', [sinks.Section('I don\'t know the Slack names of these AWS users, so I couldn\'t message them directly. Please add them to my `users.yml` file so I can message them in the future:', iam_user_names)])
+
+	# Function for posting a report, made of sinks.Section tuples, for a Slack channel. It goes through the findings pipeline, so every sink that takes reports gets it, e.g. Slack, or stdout with --no-slack.
+	def post_report(self, channel, title, sections):
+		self.get_finding_pipeline().post(channel, title, sections)
+
+	# Function for reporting a check's results. Every finding is passed to the findings pipeline, then the check posts its report. If we're keeping a findings store, only what's changed since the last run is posted. Pass complete=False if some of the results are missing (e.g. because an account couldn't be checked), so the findings we didn't see aren't taken as resolved.
+	# If only some resources were checked again, pass a scope function that tells us whether a resource was one of them. Without a findings store, we can't tell what's changed for them, so their findings are posted as new, and nothing is posted if there aren't any.
+	def report(self, check, results, complete=True, scope=None):
+		self.get_finding_pipeline().write(check.findings(results))
+		if self.settings.findings_store:
+			import findingstore
+			findingstore.report_changes(self, check, results, complete, scope)
+		elif scope is None:
+			check.report(self, results)
+		elif any(True for finding in check.findings(results)):
+			check.report(self, results, resolved=[])
@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import zlib
+from botocore.exceptions import ClientError
+
+# Stores checkpoints as JSON files in a local directory.
+class LocalCheckpointStore:
+	def __init__(self, directory):
+		self.directory = directory
+
+	def path(self, name):
+		return os.path.join(self.directory, '{}.json'.format(name))
+
+	def load(self, name):
+		try:
+			with open(self.path(name), 'r') as stream:
+				return json.load(stream)
+		except (IOError, ValueError):
+			return None
+
+	def save(self, name, state):
+		# Write to a temporary file first, so a crash can't leave a half-written checkpoint behind.
+		os.makedirs(self.directory, exist_ok=True)
+		with open(self.path(name) + '.tmp', 'w') as stream:
+			json.dump(state, stream)
+		os.replace(self.path(name) + '.tmp', self.path(name))
+
+	def clear(self, name):
+		try:
+			os.remove(self.path(name))
+		except OSError:
+			pass
+
+# Stores checkpoints as JSON objects in S3, so they survive between Lambda containers.
+class S3CheckpointStore:
+	def __init__(self, bullkit, bucket, prefix):
+		self.bullkit = bullkit
+		self.bucket = bucket
+		self.prefix = prefix
+		self.s3_client = bullkit.client('s3')
+
+	def key(self, name):
+		return '{}{}.json'.format(self.prefix, name)
+
+	def load(self, name):
+		try:
+			return json.loads(self.s3_client.get_object(Bucket=self.bucket, Key=self.key(name))['Body'].read().decode('utf-8'))
+		except ClientError as exc:
+			if exc.response['Error']['Code'] not in ('NoSuchKey', '404'):
+				raise
+			return None
+
+	def save(self, name, state):
+		self.s3_client.put_object(Bucket=self.bucket, Key=self.key(name), Body=json.dumps(state).encode('utf-8'), ServerSideEncryption='AES256')
+
+	def clear(self, name):
+		self.s3_client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+# Make the checkpoint store described by --checkpoint-store, which is either s3://bucket/prefix or a local directory.
+def checkpoint_store(bullkit):
+	location = bullkit.settings.checkpoint_store
+	if location.startswith('s3://'):
+		bucket, _, prefix = location[len('s3://'):].partition('/')
+		if prefix and not prefix.endswith('/'):
+			prefix += '/'
+		return S3CheckpointStore(bullkit, bucket, prefix)
+	return LocalCheckpointStore(location)
+
+# Work out which shard a key belongs to. This uses a checksum rather than the key's position in the list, so keys stay in the same shard as other keys come and go.
+def shard_of(key, shards):
+	return zlib.crc32(key.encode('utf-8')) % shards
+
+# A sweep of a check's keyspace (e.g. IAM user names) that's split into shards and spread over several runs. Each run checks the keys that are still pending in the current shard, records what it found, and saves a checkpoint for the next run.
+class ShardedSweep:
+	def __init__(self, bullkit, check_name, keys):
+		self.bullkit = bullkit
+		self.store = bullkit.get_checkpoint_store()
+		self.shards = bullkit.settings.shards
+		self.name = '{}-{}'.format(check_name, bullkit.account_id or 'default')
+
+		# Pick up where the last run left off, unless there's no checkpoint or the number of shards has changed.
+		self.state = self.store.load(self.name)
+		if not self.state or self.state.get('shards') != self.shards:
+			self.state = {'shards': self.shards, 'shard': 0, 'cursor': None, 'findings': {}}
+		bullkit.debug('Checking shard {} of {} of the {} sweep, starting after: {}'.format(self.state['shard'] + 1, self.shards, check_name, self.state['cursor'] or 'the beginning'))
+
+		# The keys in the current shard that we haven't checked yet, in order.
+		self.pending = sorted([key for key in keys if shard_of(key, self.shards) == self.state['shard'] and (self.state['cursor'] is None or key > self.state['cursor'])])
+
+	# Record the findings for the keys we checked, which must be JSON-serializable. Keys that are missing from the findings weren't checked (e.g. because we ran out of time), and will be checked by the next run.
+	def record(self, findings):
+		for key in self.pending:
+			if key not in findings:
+				break
+			self.state['cursor'] = key
+			if findings[key]:
+				self.state['findings'][key] = findings[key]
+		else:
+			# We checked every key in the shard, so the next run can start on the next one.
+			self.state['shard'] += 1
+			self.state['cursor'] = None
+
+	# Save the checkpoint. Returns the findings of the whole sweep if it's complete, or None if there are still shards to check.
+	def finish(self):
+		if self.state['shard'] < self.shards:
+			self.bullkit.debug('Saving the checkpoint for {}, with {} of {} shards done.'.format(self.name, self.state['shard'], self.shards))
+			self.store.save(self.name, self.state)
+			return None
+
+		self.bullkit.debug('The {} sweep is complete.'.format(self.name))
+		self.store.clear(self.name)
+		return self.state['findings']
@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import io
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+
+# How many times, and how often (in seconds), to ask IAM whether the credential report is ready.
+REPORT_POLL_ATTEMPTS = 20
+REPORT_POLL_INTERVAL = 2
+
+# The subset of credential report columns that our checks use.
+CredentialReportRow = namedtuple('CredentialReportRow', ['password_enabled', 'mfa_active', 'access_key_1_active', 'access_key_1_last_rotated', 'access_key_2_active', 'access_key_2_last_rotated'])
+
+# Convert a credential report cell into a boolean.
+def parse_flag(value):
+	return value == 'true'
+
+# Convert a credential report cell into a timezone-aware datetime, or None if there's no date.
+def parse_timestamp(value):
+	if value in ('', 'N/A', 'not_supported', 'no_information'):
+		return None
+	# Every timestamp in the report is in UTC, e.g. 2019-01-01T00:00:00+00:00.
+	return datetime.fromisoformat(value).astimezone(timezone.utc)
+
+# Parse the credential report CSV in a single pass into a dict of IAM user names to CredentialReportRows.
+def parse(content):
+	table = {}
+	reader = csv.reader(io.TextIOWrapper(io.BytesIO(content), encoding='utf-8', newline=''))
+	header = next(reader)
+	user_column = header.index('user')
+	columns = [header.index(field) for field in CredentialReportRow._fields]
+	parsers = [parse_timestamp if field.endswith('_last_rotated') else parse_flag for field in CredentialReportRow._fields]
+	for row in reader:
+		# The root account isn't an IAM user, so none of our checks apply to it.
+		if row[user_column] == '<root_account>':
+			continue
+		table[row[user_column]] = CredentialReportRow(*[parser(row[column]) for parser, column in zip(parsers, columns)])
+	return table
+
+# Generate the credential report, wait for it, and parse it. Returns None if it's unavailable or stale, in which case checks should fall back to per-user API calls.
+def load(bullkit):
+	client = bullkit.client('iam')
+
+	try:
+		# Ask IAM to generate the report until it tells us it's done. If a recent report exists, it returns COMPLETE straight away.
+		bullkit.debug('Generating the IAM credential report...')
+		for attempt in range(REPORT_POLL_ATTEMPTS):
+			state = client.generate_credential_report()['State']
+			if state == 'COMPLETE':
+				break
+			if bullkit.past_deadline():
+				bullkit.debug('Ran out of time waiting for the credential report.')
+				return None
+			bullkit.debug('The credential report is {}, waiting...'.format(state))
+			time.sleep(REPORT_POLL_INTERVAL)
+		else:
+			bullkit.debug('Gave up waiting for the credential report, so we\'ll fall back to per-user API calls.')
+			return None
+
+		report = client.get_credential_report()
+	except ClientError as exc:
+		bullkit.debug('Couldn\'t get the credential report, so we\'ll fall back to per-user API calls: {}'.format(exc))
+		return None
+
+	# Make sure the report isn't too old to be trusted.
+	report_age = datetime.now(timezone.utc) - report['GeneratedTime']
+	if report_age > timedelta(hours = bullkit.settings.credential_report_max_age):
+		bullkit.debug('The credential report is {} old, so we\'ll fall back to per-user API calls.'.format(report_age))
+		return None
+
+	table = parse(report['Content'])
+	bullkit.debug('Loaded the credential report for {} IAM users.'.format(len(table)))
+	return table
@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import inventory
+
+# The CloudTrail events that can change what our checks find, and the checks they affect. Bucket events affect the bucket they name, and IAM events affect the user they name.
+EVENT_CHECKS = {
+	'CreateBucket': ('publics3',),
+	'DeleteBucket': ('publics3',),
+	'PutBucketAcl': ('publics3',),
+	'PutBucketPolicy': ('publics3',),
+	'DeleteBucketPolicy': ('publics3',),
+	'PutBucketPublicAccessBlock': ('publics3',),
+	'DeleteBucketPublicAccessBlock': ('publics3',),
+	'CreateAccessKey': ('iamkeys',),
+	'UpdateAccessKey': ('iamkeys',),
+	'DeleteAccessKey': ('iamkeys',),
+	'EnableMFADevice': ('mfa',),
+	'DeactivateMFADevice': ('mfa',),
+	'CreateLoginProfile': ('mfa',),
+	'DeleteLoginProfile': ('mfa',),
+	'DeleteUser': ('mfa', 'iamkeys'),
+}
+
+# Unwrap an event into the CloudTrail records it carries. It may be a single CloudTrail record, an EventBridge event, a batch of messages from SQS (each of which may have come through SNS), a CloudTrail log file, or a list of any of those.
+def records(event):
+	if isinstance(event, list):
+		for item in event:
+			yield from records(item)
+	elif not isinstance(event, dict):
+		return
+	elif 'Records' in event:
+		for record in event['Records']:
+			if record.get('eventSource') == 'aws:sqs':
+				yield from records(json.loads(record['body']))
+			elif 'Sns' in record:
+				yield from records(json.loads(record['Sns']['Message']))
+			else:
+				yield from records(record)
+	elif event.get('Type') == 'Notification' and 'Message' in event:
+		yield from records(json.loads(event['Message']))
+	elif 'detail-type' in event and 'detail' in event:
+		yield from records(event['detail'])
+	elif 'eventName' in event:
+		yield event
+
+# Work out which user or bucket a CloudTrail record is about. Users who manage their own keys or MFA don't name themselves in the request, so we take them from who made it.
+def resource_name(record):
+	request = record.get('requestParameters') or {}
+	if record.get('eventSource') == 's3.amazonaws.com':
+		return request.get('bucketName')
+	response = record.get('responseElements') or {}
+	identity = record.get('userIdentity') or {}
+	return request.get('userName') or (response.get('accessKey') or {}).get('userName') or (identity.get('userName') if identity.get('type') == 'IAMUser' else None)
+
+# Work out which resources each check needs to look at again because of an event. Returns a dict of check names to sets of user or bucket names.
+def affected_resources(bullkit, event):
+	affected = {}
+	my_account_id = None
+	for record in records(event):
+		event_name = record.get('eventName')
+		if event_name not in EVENT_CHECKS:
+			bullkit.debug('Ignoring {}, which doesn\'t affect any of our checks.'.format(event_name))
+			continue
+		# We only check the account we're running in, so ignore events from others (e.g. forwarded to our event bus by another account).
+		if record.get('recipientAccountId'):
+			my_account_id = my_account_id or bullkit.account_id or inventory.account_id(bullkit)
+			if my_account_id and record['recipientAccountId'] != my_account_id:
+				bullkit.debug('Ignoring {}, which happened in account {}.'.format(event_name, record['recipientAccountId']))
+				continue
+		# Calls that failed didn't change anything.
+		if record.get('errorCode'):
+			bullkit.debug('Ignoring {}, which failed with {}.'.format(event_name, record['errorCode']))
+			continue
+		name = resource_name(record)
+		if not name:
+			bullkit.debug('Couldn\'t tell which resource {} was about, so ignoring it.'.format(event_name))
+			continue
+		for check_name in EVENT_CHECKS[event_name]:
+			affected.setdefault(check_name, set()).add(name)
+	return affected
+
+# Check just the resources affected by an event again, with each of the given checks, and report what's changed. Returns a dict of each check that was run to the resources it checked.
+def handle(bullkit, event, checks):
+	affected = affected_resources(bullkit, event)
+	checked = {}
+	for check in checks:
+		names = affected.get(check.__name__)
+		if not names or bullkit.out_of_time(check.__name__):
+			continue
+		bullkit.debug('Checking {} again with {}...'.format(', '.join(sorted(names)), check.__name__))
+		results = check.rescan(bullkit, names)
+		with bullkit.checking(check.__name__):
+			bullkit.report(check, results, scope=lambda resource: check.covered(names, resource))
+		checked[check.__name__] = sorted(names)
+	return checked
@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from botocore.exceptions import ClientError
+
+# Stores findings in a local SQLite database.
+class SQLiteFindingStore:
+	def __init__(self, path):
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		with self.connection:
+			self.connection.execute('CREATE TABLE IF NOT EXISTS findings (checkname TEXT, resource TEXT, finding TEXT, first_seen REAL, PRIMARY KEY (checkname, resource))')
+			self.connection.execute('CREATE TABLE IF NOT EXISTS digests (checkname TEXT PRIMARY KEY, sent REAL)')
+
+	# Get the findings we saved for a check, as a dict of resources to findings.
+	def previous(self, check_name):
+		with self.lock:
+			return {resource: finding for resource, finding in self.connection.execute('SELECT resource, finding FROM findings WHERE checkname = ?', (check_name,))}
+
+	# Save a check's findings. Unless we're told to keep them, any findings we previously saved for resources that aren't in the new findings are removed.
+	def update(self, check_name, findings, keep_missing=False):
+		now = time.time()
+		with self.lock, self.connection:
+			if not keep_missing:
+				self.connection.execute('DELETE FROM findings WHERE checkname = ?', (check_name,))
+			for resource, finding in findings.items():
+				self.connection.execute('INSERT OR IGNORE INTO findings VALUES (?, ?, ?, ?)', (check_name, resource, finding, now))
+				self.connection.execute('UPDATE findings SET finding = ? WHERE checkname = ? AND resource = ?', (finding, check_name, resource))
+
+	# Forget a check's findings for the given resources.
+	def remove(self, check_name, resources):
+		with self.lock, self.connection:
+			self.connection.executemany('DELETE FROM findings WHERE checkname = ? AND resource = ?', [(check_name, resource) for resource in resources])
+
+	# Get when we last sent a full digest for a check, or 0 if we never have.
+	def last_digest(self, check_name):
+		with self.lock:
+			row = self.connection.execute('SELECT sent FROM digests WHERE checkname = ?', (check_name,)).fetchone()
+		return row[0] if row else 0
+
+	def digest_sent(self, check_name):
+		with self.lock, self.connection:
+			self.connection.execute('INSERT OR REPLACE INTO digests VALUES (?, ?)', (check_name, time.time()))
+
+	def close(self):
+		self.connection.close()
+
+# Stores findings in a JSON object in S3, so they survive between Lambda containers. The object is read once, and written back when the store is closed.
+class S3FindingStore:
+	def __init__(self, bullkit, bucket, key):
+		self.bullkit = bullkit
+		self.bucket = bucket
+		self.key = key
+		self.lock = threading.Lock()
+		self.s3_client = bullkit.client('s3')
+		try:
+			self.state = json.loads(self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8'))
+		except ClientError as exc:
+			if exc.response['Error']['Code'] not in ('NoSuchKey', '404'):
+				raise
+			self.state = {'findings': {}, 'digests': {}}
+
+	def previous(self, check_name):
+		with self.lock:
+			return {resource: saved[0] for resource, saved in self.state['findings'].get(check_name, {}).items()}
+
+	def update(self, check_name, findings, keep_missing=False):
+		now = time.time()
+		with self.lock:
+			saved_findings = self.state['findings'].get(check_name, {})
+			updated_findings = dict(saved_findings) if keep_missing else {}
+			for resource, finding in findings.items():
+				updated_findings[resource] = [finding, saved_findings.get(resource, [None, now])[1]]
+			self.state['findings'][check_name] = updated_findings
+
+	def remove(self, check_name, resources):
+		with self.lock:
+			saved_findings = self.state['findings'].get(check_name, {})
+			for resource in resources:
+				saved_findings.pop(resource, None)
+
+	def last_digest(self, check_name):
+		with self.lock:
+			return self.state['digests'].get(check_name, 0)
+
+	def digest_sent(self, check_name):
+		with self.lock:
+			self.state['digests'][check_name] = time.time()
+
+	def close(self):
+		self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=json.dumps(self.state).encode('utf-8'), ServerSideEncryption='AES256')
+
+# Make the findings store described by --findings-store, which is either s3://bucket/key or the path of a SQLite database.
+def finding_store(bullkit):
+	location = bullkit.settings.findings_store
+	if location.startswith('s3://'):
+		bucket, _, key = location[len('s3://'):].partition('/')
+		return S3FindingStore(bullkit, bucket, key)
+	return SQLiteFindingStore(location)
+
+# Report a check's results, compared with the findings we saved last time. Unless a full digest is due, only new findings, findings that have changed (e.g. a key that's gone from expiring to expired) and findings that have been resolved are reported.
+# If only some resources were checked again (e.g. because of an event), scope says which: it's a function that tells us whether a resource was checked. Findings for other resources are left as they are, and no digest is sent.
+def report_changes(bullkit, check, results, complete=True, scope=None):
+	check_name = check.__name__
+	store = bullkit.get_finding_store()
+	findings = {finding.resource: finding.finding for finding in check.findings(results)}
+	previous_findings = store.previous(check_name)
+
+	if scope is not None:
+		previous_findings = {resource: finding for resource, finding in previous_findings.items() if scope(resource)}
+		resolved = sorted([resource for resource in previous_findings if resource not in findings])
+		store.update(check_name, findings, keep_missing=True)
+		store.remove(check_name, resolved)
+		changed = [resource for resource, finding in findings.items() if previous_findings.get(resource) != finding]
+		bullkit.debug('{} has {} new or changed findings, and {} resolved findings, among the resources we checked again.'.format(check_name, len(changed), len(resolved)))
+		if changed or resolved:
+			check.report(bullkit, check.select(results, changed), resolved=resolved)
+		return
+
+	# If a check didn't finish, anything it didn't get to would look resolved, so only add to what we've saved.
+	complete = complete and not bullkit.was_cut_short(check_name)
+	store.update(check_name, findings, keep_missing=not complete)
+
+	# Send everything if it's been long enough since the last full digest.
+	if time.time() - store.last_digest(check_name) >= bullkit.settings.full_digest_days * 86400:
+		bullkit.debug('Sending a full digest for {}.'.format(check_name))
+		check.report(bullkit, results)
+		store.digest_sent(check_name)
+		return
+
+	changed = [resource for resource, finding in findings.items() if previous_findings.get(resource) != finding]
+	resolved = sorted([resource for resource in previous_findings if resource not in findings]) if complete else []
+	bullkit.debug('{} has {} new or changed findings, and {} resolved findings.'.format(check_name, len(changed), len(resolved)))
+	if changed or resolved:
+		check.report(bullkit, check.select(results, changed), resolved=resolved)
@@ -15,61 +15,130 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import boto3
-from datetime import datetime, timedelta
-from pytz import timezone
-import yaml
-
-def iamkeys (bullkit):
+import functools
+from datetime import datetime, timedelta, timezone
+from bullkit import INCOMPLETE_MESSAGE
+from sinks import Finding, Section
+import rules
+
+# The format in which key expiration times are kept, e.g. in checkpoints.
+EXPIRATION_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# The ages after which we warn about keys and at which they expire. They're the same for every user, so they're only worked out once.
+@functools.lru_cache(maxsize=None)
+def key_ages(warn_days, expire_days):
+	return timedelta(days = warn_days), timedelta(days = expire_days)
+
+# Find an IAM user's active access keys that are old enough to warn about, as a list of dicts containing each key's ID and when it expires (or expired). Rather than how long keys have left, we keep when they expire, since with --checkpoint-store it might be several runs before we report them.
+def old_keys(inventory, iam_user_name):
+	access_key_warn_age, access_key_expire_age = key_ages(inventory.bullkit.settings.iam_keys_warn_age, inventory.bullkit.settings.iam_keys_expire_age)
+	warn_cutoff = inventory.now - access_key_warn_age
+
+	# If we have a credential report, only look up the access keys of users who have an active key that's old enough to warn about.
+	credentials = inventory.credentials(iam_user_name)
+	if credentials is not None and not ((credentials.access_key_1_active and credentials.access_key_1_last_rotated and credentials.access_key_1_last_rotated <= warn_cutoff) or (credentials.access_key_2_active and credentials.access_key_2_last_rotated and credentials.access_key_2_last_rotated <= warn_cutoff)):
+		return []
+
+	# Iterate through each of the IAM user's access keys.
+	inventory.bullkit.debug('Checking the access keys of: {}'.format(iam_user_name))
+	encoded_keys = []
+	for access_key in inventory.get('access keys', iam_user_name):
+		inventory.bullkit.debug('Checking access key: {}'.format(access_key.id))
+
+		# Calculate the age of the key.
+		access_key_age = inventory.now - access_key.created
+		inventory.bullkit.debug('Access key\'s age: {}'.format(access_key_age))
+
+		# If the key is approaching expiration or has expired...
+		if access_key_age >= access_key_warn_age and access_key.status == 'Active':
+			if access_key_age < access_key_expire_age:
+				inventory.bullkit.debug('Key {} is approaching expiration.'.format(access_key.id))
+			else:
+				inventory.bullkit.debug('Key {} is expired.'.format(access_key.id))
+			encoded_keys.append({'id': access_key.id, 'expires': (access_key.created + access_key_expire_age).strftime(EXPIRATION_FORMAT)})
+
+	return encoded_keys
+
+# Collect the users' old keys into keys_to_warn and expired_keys.
+def collect(inventory, findings):
+	return decode_keys(findings, inventory.now)
+
+# The rule each IAM user must pass: none of their active access keys may be old enough to warn about. It's spread over several runs with --checkpoint-store.
+RULE = rules.Rule('iamkeys', 'users', ('credential report', 'users', 'access keys'), old_keys, collect, sweep=True)
+
+# Check just the given IAM users' access keys again, e.g. because one of them has created or deactivated a key. Users who no longer exist have no keys.
+def rescan(bullkit, iam_user_names):
+	return rules.scan(bullkit, [RULE], names=iam_user_names)['iamkeys']
+
+# Work out whether a resource in our findings (a user and access key) belongs to one of the given users.
+def covered(iam_user_names, resource):
+	return resource.split('/')[-2] in iam_user_names
+
+# Convert users' old keys, which may have been saved in a checkpoint, into keys_to_warn and expired_keys, moving any that have expired since they were found.
+def decode_keys(findings, utcnow):
+	keys_to_warn = {}
 	expired_keys = {}
+	for iam_user_name, encoded_keys in sorted(findings.items()):
+		for access_key in encoded_keys:
+			time_left = datetime.strptime(access_key['expires'], EXPIRATION_FORMAT).replace(tzinfo=timezone.utc) - utcnow
+			if time_left > timedelta(0):
+				keys_to_warn.setdefault(iam_user_name, []).append({'id': access_key['id'], 'time left': time_left})
+			else:
+				expired_keys.setdefault(iam_user_name, []).append(access_key['id'])
+	return keys_to_warn, expired_keys
+
+# Combine the results of scanning several accounts, labelling each user with their account ID.
+def merge(results_by_account):
 	keys_to_warn = {}
-
-	# Iterate through each IAM user.
-	bullkit.debug('Getting the list of IAM users...')
-	iam = boto3.resource('iam')
-	for iam_user in iam.users.all():
-		# Iterate through each of the IAM user's access keys.
-		iam_user_name = iam_user.name
-		bullkit.debug('Checking the access keys of: {}'.format(iam_user_name))
-		for access_key in iam.User(iam_user_name).access_keys.all():
-			access_key_id = access_key.access_key_id
-			bullkit.debug('Checking access key: {}'.format(access_key_id))
-
-			# Calculate the age of the keys (converting to UTC where necessary).
-			utcnow = timezone('UTC').localize(datetime.utcnow())
-			access_key_age = utcnow - access_key.create_date
-			bullkit.debug('Access key\'s age: {}'.format(access_key_age))
-			access_key_warn_age = timedelta(days = float(bullkit.commandargs.parse_args().iam_keys_warn_age))
-			access_key_expire_age = timedelta(days = float(bullkit.commandargs.parse_args().iam_keys_expire_age))
-
-			# If the key is approaching expiration...
-			if access_key_age >= access_key_warn_age and access_key_age < access_key_expire_age and access_key.status == 'Active':
-				bullkit.debug('Key {} is approaching expiration.'.format(access_key_id))
-				# Assemble the keys into lists with the user name as their key. Each item in the list is a dict containing the key's ID and time until expiration.
-				if not keys_to_warn.get(iam_user_name):
-					keys_to_warn[iam_user_name] = []
-				key_approaching_expiration = {'id': access_key_id, 'time left': access_key_expire_age - access_key_age}
-				keys_to_warn[iam_user_name].append(key_approaching_expiration)
-
-			# If the key is expired...
-			if access_key_age >= access_key_expire_age and access_key.status == 'Active':
-				bullkit.debug('Key {} is expired.'.format(access_key_id))
-				# Assemble the keys into lists with the user name as their key.
-				if not expired_keys.get(iam_user_name):
-					expired_keys[iam_user_name] = []
-				expired_keys[iam_user_name].append(access_key_id)
-
-	# If we didn't find any access keys that are approaching expiration or have expired...
-	if not keys_to_warn and not expired_keys:
+	expired_keys = {}
+	for account_id, (account_keys_to_warn, account_expired_keys) in sorted(results_by_account.items()):
+		for iam_user_name, access_keys in account_keys_to_warn.items():
+			keys_to_warn['{}/{}'.format(account_id, iam_user_name)] = access_keys
+		for iam_user_name, access_keys in account_expired_keys.items():
+			expired_keys['{}/{}'.format(account_id, iam_user_name)] = access_keys
+	return keys_to_warn, expired_keys
+
+# Generate a finding for each access key, keyed by user and access key. A key's finding changes when it goes from expiring soon to expired.
+def findings(results):
+	keys_to_warn, expired_keys = results
+	for iam_user_name, access_keys in keys_to_warn.items():
+		for access_key in access_keys:
+			yield Finding('iamkeys', '{}/{}'.format(iam_user_name, access_key['id']), 'expiring', {'user': iam_user_name, 'access key': access_key['id'], 'days left': access_key['time left'].days})
+	for iam_user_name, access_key_ids in expired_keys.items():
+		for access_key_id in access_key_ids:
+			yield Finding('iamkeys', '{}/{}'.format(iam_user_name, access_key_id), 'expired', {'user': iam_user_name, 'access key': access_key_id})
+
+# Narrow the results down to the given access keys.
+def select(results, resources):
+	keys_to_warn, expired_keys = results
+	resources = set(resources)
+	selected_keys_to_warn = {}
+	selected_expired_keys = {}
+	for iam_user_name, access_keys in keys_to_warn.items():
+		for access_key in access_keys:
+			if '{}/{}'.format(iam_user_name, access_key['id']) in resources:
+				selected_keys_to_warn.setdefault(iam_user_name, []).append(access_key)
+	for iam_user_name, access_key_ids in expired_keys.items():
+		for access_key_id in access_key_ids:
+			if '{}/{}'.format(iam_user_name, access_key_id) in resources:
+				selected_expired_keys.setdefault(iam_user_name, []).append(access_key_id)
+	return selected_keys_to_warn, selected_expired_keys
+
+# Report the access keys that need to be deactivated. If we're given the keys that have been resolved since the last report, only the changes are reported.
+def report(bullkit, results, resolved=None):
+	keys_to_warn, expired_keys = results
+
+	# If we didn't find any access keys that are approaching expiration or have expired (and we checked them all)...
+	if not keys_to_warn and not expired_keys and not resolved and not bullkit.was_cut_short('iamkeys'):
 		bullkit.debug('No issues found with access keys.')
 	
 	# If we found access keys that are approaching expiration or have expired...
 	else:
-		# Since it's uncertain how many parts to this message there will be, store them in a list and collapse it into a string at the end.
-		slackmsg_list = []
+		# Since it's uncertain how many parts to this report there will be, store them in a list.
+		sections = []
 
 		if keys_to_warn:
-			# Format the list into a string for a Slack message.
+			# Lay out the list for Slack.
 			bullkit.debug('Found these access keys that are approaching expiration: {}'.format(keys_to_warn))
 			bullkit.debug('Formatting the list of keys that expire soon...')
 			keys_to_warn_list = []
@@ -77,53 +146,53 @@ def iamkeys (bullkit):
 				access_key_id = access_key[0]['id']
 				access_key_days_left = access_key[0]['time left'].days
 				keys_to_warn_list.append('{}: {} (expires in {} days)'.format(iam_user_name, access_key_id, access_key_days_left))
-			keys_to_warn_str = '\n'.join(keys_to_warn_list)
-			slackmsg_list.append('The following IAM access keys expire soon:\n```{}```\nThey should be deactivated and replaced ASAP.'.format(keys_to_warn_str))
+			sections.append(Section('The following IAM access keys expire soon:', keys_to_warn_list, 'They should be deactivated and replaced ASAP.'))
 
 		if expired_keys:
-			# Format the list into a string for a Slack message.
+			# Lay out the list for Slack.
 			bullkit.debug('Found these expired access keys: {}'.format(expired_keys))
 			bullkit.debug('Formatting the list of expired access keys...')
 			expired_keys_list = []
 			for iam_user_name, access_key in expired_keys.items():
 				expired_key = '{}: {}'.format(iam_user_name, access_key)
 				expired_keys_list.append(expired_key)
-			expired_keys_str = '\n'.join(expired_keys_list)
-			slackmsg_list.append('The following IAM access keys are expired:\n```{}```\nThey should be deactivated and replaced immediately.'.format(expired_keys_str))
+			sections.append(Section('The following IAM access keys are expired:', expired_keys_list, 'They should be deactivated and replaced immediately.'))
+
+		if resolved:
+			sections.append(Section('These IAM access keys have been deactivated or deleted since my last report:', resolved))
 
-		# Collapse the list of message parts into one string.
-		slackmsg = '\n\n'.join(slackmsg_list)
+		# If we ran out of time, say that the lists are incomplete.
+		if bullkit.was_cut_short('iamkeys'):
+			if not sections:
+				sections.append(Section('I didn\'t find any IAM access keys that expire soon or have expired.'))
+			sections.append(Section(INCOMPLETE_MESSAGE))
 
-		# If we've been told to post to Slack...
-		if not bullkit.commandargs.parse_args().no_slack:
-			# Post the list to the relevant Slack channel.
-			bullkit.debug('Sending the list to Slack...')
-			bullkit.send_slack_message(bullkit.commandargs.parse_args().iam_keys_channel, 'AWS Security Bot', ':robot_face:', slackmsg)
+		# Post the list to the relevant Slack channel, split into several messages if it's long.
+		bullkit.debug('Sending the list...')
+		bullkit.post_report(bullkit.settings.iam_keys_channel, 'Old IAM access keys', sections)
 
+		# If we're posting to Slack...
+		if not bullkit.settings.no_slack:
 			# If there are users who need to deactivate their keys and we've been told to nag them...
-			if bullkit.commandargs.parse_args().iam_keys_nag_users:
+			if (keys_to_warn or expired_keys) and bullkit.settings.iam_keys_nag_users:
 				# Load the map of AWS users to Slack users.
 				bullkit.debug('Trying to load the map of AWS users to Slack users...')
-				try:
-					with open('users.yml', 'r') as stream:
-						try:
-							slack_users = yaml.safe_load(stream)
-						except yaml.YAMLError as exc:
-							print(exc)
-				except IOError:
-					bullkit.debug('users.yml can\'t be read, so we\'ll skip messaging Slack users directly.')
+				slack_users = bullkit.get_slack_users()
 				bullkit.debug('Loaded:\n{}'.format(slack_users))
 
 				# If we were able to assemble a map of AWS users to Slack users...
 				if slack_users:
 					# Assemble a list of users that need notification.
-					bad_iam_users = [*keys_to_warn, *expired_keys]
+					bad_iam_users = sorted(set([*keys_to_warn, *expired_keys]))
 
 					# Try to message each user directly via Slack.
 					bullkit.debug('Iterating through bad AWS users to see if we can Slack them directly...')
+					unknown_users = []
 					for bad_iam_user in bad_iam_users:
-						if bad_iam_user in slack_users.keys():
-							bad_slack_user = slack_users[bad_iam_user]
+						# Users from other accounts are labelled with their account ID, which isn't part of their name in users.yml.
+						iam_user_name = bad_iam_user.split('/')[-1]
+						if iam_user_name in slack_users.keys():
+							bad_slack_user = slack_users[iam_user_name]
 							if bad_slack_user is not False:
 								bullkit.debug('Trying to message @{}'.format(bad_slack_user))
 
@@ -146,16 +215,10 @@ def iamkeys (bullkit):
 								bullkit.debug('Message body: {}'.format(slackmsg))
 
 								# Send the Slack message.
-								bad_slack_user = slack_users[bad_iam_user]
-								bullkit.send_slack_message('@{}'.format(bad_slack_user), 'AWS Security Bot', ':robot_face:', slackmsg)
+								bullkit.send_slack_message(bullkit.slack_dm_channel(bad_slack_user), 'AWS Security Bot', ':robot_face:', slackmsg)
 							else:
 								bullkit.debug('Ignoring {} because it\'s set to False in users.yml.'.format(bad_iam_user))
 						else:
 							bullkit.debug('Couldn\'t find AWS user {} in the user map.'.format(bad_iam_user))
-							slackmsg='I don\'t know the Slack name of the AWS user `{}` so I could not send them a message directly. Please update my `users.yml` file so I can message them in the future.'.format(bad_iam_user)
-							bullkit.send_slack_message(bullkit.commandargs.parse_args().iam_keys_channel, 'AWS Security Bot', ':robot_face:', slackmsg)
-
-		# If we've been told to *not* post to Slack...
-		else:
-			# Print the list to standard output.
-			print(slackmsg)
+							unknown_users.append(bad_iam_user)
+					bullkit.report_unknown_slack_users(bullkit.settings.iam_keys_channel, unknown_users)
@@ -0,0 +1,262 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+import bucketregions
+
+# An IAM access key, and when it was created.
+AccessKey = namedtuple('AccessKey', ['id', 'status', 'created'])
+
+# Grantees that make a bucket public.
+PUBLIC_GRANTEE_URIS = ['http://acs.amazonaws.com/groups/global/AllUsers', 'http://acs.amazonaws.com/groups/global/AuthenticatedUsers']
+
+# Settings in a public access block, none of which are enabled if there's no public access block configured.
+NO_PUBLIC_ACCESS_BLOCK = {'BlockPublicAcls': False, 'IgnorePublicAcls': False, 'BlockPublicPolicy': False, 'RestrictPublicBuckets': False}
+
+# The datasets an AccountInventory can fetch, and what each one is about: the whole account, or a single user or bucket.
+DATASETS = {
+	'account id': 'account',
+	'credential report': 'account',
+	'users': 'account',
+	'account public access block': 'account',
+	'buckets': 'account',
+	'mfa devices': 'user',
+	'login profile': 'user',
+	'access keys': 'user',
+	'bucket public access block': 'bucket',
+	'bucket policy status': 'bucket',
+	'bucket acl': 'bucket',
+}
+
+# Get a public access block configuration, treating a missing or unreadable one as if nothing were blocked.
+def public_access_block(bullkit, function, **kwargs):
+	try:
+		return function(**kwargs)['PublicAccessBlockConfiguration']
+	except ClientError as exc:
+		if exc.response['Error']['Code'] != 'NoSuchPublicAccessBlockConfiguration':
+			bullkit.debug('Couldn\'t read the public access block, so we\'ll assume there isn\'t one: {}'.format(exc))
+		return NO_PUBLIC_ACCESS_BLOCK
+
+# Get the ID of the account we're checking, or None if we can't work it out.
+def account_id(bullkit):
+	try:
+		return bullkit.client('sts').get_caller_identity()['Account']
+	except ClientError as exc:
+		bullkit.debug('Couldn\'t work out our account ID: {}'.format(exc))
+		return None
+
+# What the checks' rules need to know about an account, fetched lazily as they ask for it. Each dataset is fetched once per account (or once per user or bucket), however many rules use it, and it's safe for several threads to ask for the same one at once.
+class AccountInventory:
+	def __init__(self, bullkit, use_credential_report=True):
+		self.bullkit = bullkit
+		# Whether we can use the credential report, which can be a few hours out of date.
+		self.use_credential_report = use_credential_report
+		# When we started looking at the account, which the rules measure ages against.
+		self.now = datetime.now(timezone.utc)
+		self.lock = threading.Lock()
+		# The datasets we've fetched, keyed by dataset and user or bucket name (or None for account datasets), and a lock for each one we're fetching. A user's or bucket's datasets are forgotten once its rules have been evaluated.
+		self.values = {}
+		self.fetch_locks = {}
+		self.regions = None
+		self.fetchers = {
+			'account id': self.fetch_account_id,
+			'credential report': self.fetch_credential_report,
+			'users': self.fetch_users,
+			'account public access block': self.fetch_account_public_access_block,
+			'buckets': self.fetch_buckets,
+			'mfa devices': self.fetch_mfa_devices,
+			'login profile': self.fetch_login_profile,
+			'access keys': self.fetch_access_keys,
+			'bucket public access block': self.fetch_bucket_public_access_block,
+			'bucket policy status': self.fetch_bucket_policy_status,
+			'bucket acl': self.fetch_bucket_acl,
+		}
+
+	# Get a dataset, fetching it if we haven't already. User and bucket datasets are for the given user or bucket.
+	def get(self, dataset, name=None):
+		key = (dataset, name)
+		with self.lock:
+			if key in self.values:
+				return self.values[key]
+			fetch_lock = self.fetch_locks.setdefault(key, threading.Lock())
+
+		# Only one thread fetches each dataset. Any others wait for it, then use what it fetched.
+		with fetch_lock:
+			with self.lock:
+				if key in self.values:
+					return self.values[key]
+			value = self.fetchers[dataset]() if name is None else self.fetchers[dataset](name)
+			with self.lock:
+				self.values[key] = value
+				self.fetch_locks.pop(key, None)
+			return value
+
+	# Forget the given datasets for a user or bucket once nothing else needs them, so we only hold on to what we know about the whole account, however many users and buckets it has.
+	def forget(self, datasets, name):
+		with self.lock:
+			for dataset in datasets:
+				self.values.pop((dataset, name), None)
+
+	# Get a user's row of the credential report, or None if we aren't using one.
+	def credentials(self, user_name):
+		credential_report = self.get('credential report')
+		if credential_report is None:
+			return None
+		return credential_report.get(user_name)
+
+	# Get the S3 client for a bucket's region, so S3 doesn't have to redirect us.
+	def bucket_client(self, bucket_name):
+		return self.get_bucket_regions().client_for(bucket_name)
+
+	# Get the cache of which region each bucket is in, creating it if we haven't already.
+	def get_bucket_regions(self):
+		with self.lock:
+			if self.regions is None:
+				# Unlike resources, boto3 clients are thread-safe, so all of the workers can share each region's client as long as its connection pool is big enough.
+				pool_connections = max(self.bullkit.settings.public_s3_workers, self.bullkit.settings.aws_max_pool_connections)
+				self.regions = bucketregions.BucketRegions(self.bullkit, self.bullkit.account_id or account_id(self.bullkit) or 'default', pool_connections)
+			return self.regions
+
+	# Remember the regions of any new buckets for next time.
+	def save(self):
+		if self.regions is not None:
+			self.regions.save()
+
+	# The ID of the account, or None if we can't work it out.
+	def fetch_account_id(self):
+		return self.bullkit.account_id or account_id(self.bullkit)
+
+	# The credential report, or None if we haven't been asked to use it or can't use it here.
+	def fetch_credential_report(self):
+		if not self.use_credential_report:
+			return None
+		return self.bullkit.get_credential_report()
+
+	# The names of the account's IAM users, which the credential report tells us if we have one.
+	def fetch_users(self):
+		credential_report = self.get('credential report')
+		if credential_report is not None:
+			return list(credential_report)
+		self.bullkit.debug('Getting the list of IAM users...')
+		iam = self.bullkit.client('iam')
+		return [iam_user['UserName'] for page in iam.get_paginator('list_users').paginate() for iam_user in page['Users']]
+
+	# The account-wide public access block.
+	def fetch_account_public_access_block(self):
+		self.bullkit.debug('Getting the account\'s public access block...')
+		my_account_id = self.get('account id')
+		if my_account_id is None:
+			return NO_PUBLIC_ACCESS_BLOCK
+		return public_access_block(self.bullkit, self.bullkit.client('s3control').get_public_access_block, AccountId=my_account_id)
+
+	# The names of the account's S3 buckets. We forget the regions of any buckets that have gone.
+	def fetch_buckets(self):
+		self.bullkit.debug('Getting the list of S3 buckets...')
+		regions = self.get_bucket_regions()
+		bucket_names = [bucket['Name'] for bucket in regions.client('us-east-1').list_buckets()['Buckets']]
+		regions.prune(bucket_names)
+		return bucket_names
+
+	# A user's MFA devices.
+	def fetch_mfa_devices(self, user_name):
+		iam = self.bullkit.client('iam')
+		return [mfa_device for page in iam.get_paginator('list_mfa_devices').paginate(UserName=user_name) for mfa_device in page['MFADevices']]
+
+	# Whether a user has a password, which they do if we can get their login profile.
+	def fetch_login_profile(self, user_name):
+		iam = self.bullkit.client('iam')
+		try:
+			iam.get_login_profile(UserName=user_name)
+			return True
+		except iam.exceptions.NoSuchEntityException:
+			return False
+
+	# A user's access keys, active or not.
+	def fetch_access_keys(self, user_name):
+		iam = self.bullkit.client('iam')
+		return [AccessKey(access_key['AccessKeyId'], access_key['Status'], access_key['CreateDate']) for page in iam.get_paginator('list_access_keys').paginate(UserName=user_name) for access_key in page['AccessKeyMetadata']]
+
+	# A bucket's own public access block.
+	def fetch_bucket_public_access_block(self, bucket_name):
+		return public_access_block(self.bullkit, self.bucket_client(bucket_name).get_public_access_block, Bucket=bucket_name)
+
+	# Whether S3 says a bucket's policy makes it public.
+	def fetch_bucket_policy_status(self, bucket_name):
+		try:
+			return self.bucket_client(bucket_name).get_bucket_policy_status(Bucket=bucket_name)['PolicyStatus']['IsPublic']
+		except ClientError as exc:
+			if exc.response['Error']['Code'] != 'NoSuchBucketPolicy':
+				self.bullkit.debug('Couldn\'t get the policy status of {}: {}'.format(bucket_name, exc))
+			return False
+
+	# The permissions a bucket's ACL grants to the public.
+	def fetch_bucket_acl(self, bucket_name):
+		self.bullkit.debug('Checking the ACL of: {}'.format(bucket_name))
+		permissions = []
+		for grant in self.bucket_client(bucket_name).get_bucket_acl(Bucket=bucket_name)['Grants']:
+			if grant['Grantee']['Type'] == 'Group' and 'URI' in grant['Grantee'].keys():
+				if grant['Grantee']['URI'] in PUBLIC_GRANTEE_URIS:
+					permissions.append(grant['Permission'])
+		return permissions
+
+# What we know about an account's IAM users and S3 buckets at one point in time. It's never changed once it's built, so it can be read by any number of threads while a newer one is being built.
+class Inventory:
+	def __init__(self, access_keys, users_without_mfa, bucket_names, public_buckets, scanned_at=None):
+		# A dict of every IAM user's name to a list of their AccessKeys.
+		self.access_keys = access_keys
+		# The names of the users who have a password but no MFA.
+		self.users_without_mfa = sorted(users_without_mfa)
+		# The names of every bucket, and a dict of the public ones to the permissions they grant the public.
+		self.bucket_names = set(bucket_names)
+		self.public_buckets = public_buckets
+		self.scanned_at = time.time() if scanned_at is None else scanned_at
+
+	# The permissions a bucket grants the public, which are empty if it isn't public. Returns None if there's no such bucket.
+	def bucket_permissions(self, bucket_name):
+		if bucket_name not in self.bucket_names:
+			return None
+		return self.public_buckets.get(bucket_name, [])
+
+	# A user's active access keys, and when each of them expires given the maximum age of a key. Returns None if there's no such user.
+	def key_expirations(self, user_name, expire_age):
+		if user_name not in self.access_keys:
+			return None
+		return [(access_key, access_key.created + timedelta(days=expire_age)) for access_key in self.access_keys[user_name] if access_key.status == 'Active']
+
+# Build an inventory of the account a Bullkit checks. It should be a fresh Bullkit, so the calls that the checks share (like listing users and buckets) are only made once for this inventory, but aren't reused from an older one.
+def scan(bullkit):
+	import mfa
+	import publics3
+	import rules
+
+	# The MFA and public S3 rules tell us which users and buckets have problems. They're evaluated over the same AccountInventory we take everything else from, so nothing is fetched twice.
+	account_inventory = AccountInventory(bullkit)
+	results = rules.scan(bullkit, [mfa.RULE, publics3.RULE], my_inventory=account_inventory)
+
+	# We also need every user's access keys, so we can say when each expires.
+	bullkit.debug('Getting the access keys of every IAM user...')
+	access_keys = {user_name: account_inventory.get('access keys', user_name) for user_name in account_inventory.get('users')}
+
+	# And the name of every bucket, so we can tell a private bucket from one that doesn't exist.
+	bucket_names = account_inventory.get('buckets')
+	account_inventory.save()
+
+	return Inventory(access_keys, results['mfa'], bucket_names, results['publics3'])
@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import contextvars
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# Error codes AWS uses to tell us we're making requests too quickly.
+THROTTLING_ERROR_CODES = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'RequestThrottled', 'TooManyRequestsException')
+
+# Error codes that are expected answers rather than failures: the checks ask for things that often don't exist, like a user's login profile or a bucket's policy, and treat "not found" as an answer (see inventory.py and rules.MISSING_RESOURCE_CODES). Likewise, the checkpoint and findings stores start out without their objects. These are counted as NotFound rather than Errors, so an alarm on Errors only fires on real failures.
+NOT_FOUND_ERROR_CODES = ('NoSuchBucket', 'NoSuchBucketPolicy', 'NoSuchEntity', 'NoSuchKey', 'NoSuchPublicAccessBlockConfiguration')
+
+# The check whose calls are being made, set by Bullkit.checking(). Calls made outside any check (e.g. listing our organization's accounts) are counted against the run as a whole.
+current_check = contextvars.ContextVar('current_check', default=None)
+RUN = 'run'
+
+# The latency percentiles we report for each operation.
+PERCENTILES = (50, 90, 99)
+
+# What we know about the calls a check made to one operation, e.g. iam.ListUsers or slack.chat.postMessage.
+class OperationStats:
+	def __init__(self):
+		self.calls = 0
+		self.memoized = 0
+		self.retries = 0
+		self.throttles = 0
+		self.errors = 0
+		self.not_found = 0
+		self.latencies = []
+
+	# The given percentile of the calls' latencies, in milliseconds.
+	def latency(self, percentile):
+		latencies = sorted(self.latencies)
+		return latencies[max(0, -(-len(latencies) * percentile // 100) - 1)] * 1000
+
+# Records what each check does: how long it takes, and how many calls it makes to AWS and Slack, how long they take, and how often they're retried or throttled. Shared by every account we check, so the metrics cover the whole run.
+class Metrics:
+	def __init__(self, bullkit):
+		self.bullkit = bullkit
+		self.lock = threading.Lock()
+		self.operations = defaultdict(OperationStats)
+		self.wall_times = defaultdict(float)
+
+	# Count the calls made in this block, and unless we're told otherwise, the time it takes, against a check. Times are added up, so a check that's run against several accounts reports its total time.
+	@contextlib.contextmanager
+	def check(self, check_name, timed=True):
+		token = current_check.set(check_name)
+		started = time.time()
+		try:
+			yield
+		finally:
+			if timed:
+				self.add_wall_time(check_name, time.time() - started)
+			current_check.reset(token)
+
+	# Add to the time a check has taken, e.g. for a pass over an account's resources that evaluated several checks' rules at once.
+	def add_wall_time(self, check_name, seconds):
+		with self.lock:
+			self.wall_times[check_name] += seconds
+
+	# Record a call to an operation, against the check that's making it.
+	def record(self, operation, latency=None, retries=0, throttles=0, error=False, not_found=False, memoized=False):
+		with self.lock:
+			stats = self.operations[(current_check.get() or RUN, operation)]
+			if memoized:
+				stats.memoized += 1
+				return
+			stats.calls += 1
+			stats.retries += retries
+			stats.throttles += throttles
+			stats.errors += int(error)
+			stats.not_found += int(not_found)
+			if latency is not None:
+				stats.latencies.append(latency)
+
+	# Hook into a boto3 client's calls. This should be done after any hooks that answer calls without sending them (like memoization), so only calls that are sent are timed.
+	def register(self, client):
+		client.meta.events.register('before-call', self.before_call)
+		client.meta.events.register('needs-retry', self.needs_retry)
+		client.meta.events.register('after-call', self.after_call)
+		client.meta.events.register('after-call-error', self.after_call_error)
+
+	def before_call(self, context, **kwargs):
+		context['metrics_started'] = time.time()
+		return None
+
+	# After each attempt at a call, note how many attempts there have been, and whether AWS throttled it.
+	def needs_retry(self, attempts, request_dict, response=None, **kwargs):
+		context = request_dict['context']
+		context['metrics_attempts'] = attempts
+		if response is not None and response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+			context['metrics_throttles'] = context.get('metrics_throttles', 0) + 1
+		return None
+
+	# After a call, note whether it failed, or got one of the "not found" answers we expect.
+	def after_call(self, http_response, parsed, model, context, **kwargs):
+		not_found = http_response.status_code >= 300 and parsed.get('Error', {}).get('Code') in NOT_FOUND_ERROR_CODES
+		self.record_call(model, context, error=http_response.status_code >= 300 and not not_found, not_found=not_found)
+
+	def after_call_error(self, model, context, **kwargs):
+		self.record_call(model, context, error=True)
+
+	def record_call(self, model, context, error, not_found=False):
+		operation = '{}.{}'.format(model.service_model.service_name, model.name)
+		if 'metrics_started' not in context:
+			self.record(operation, memoized=True)
+			return
+		self.record(operation, time.time() - context['metrics_started'], max(0, context.get('metrics_attempts', 1) - 1), context.get('metrics_throttles', 0), error, not_found)
+
+	# Build a CloudWatch Embedded Metric Format document for some metrics and the dimensions they're for.
+	def emf_document(self, dimensions, metrics, timestamp):
+		document = {'_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{'Namespace': self.bullkit.settings.metrics_namespace, 'Dimensions': [sorted(dimensions)], 'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in sorted(metrics.items())]}]}}
+		document.update(dimensions)
+		document.update({name: value for name, (value, unit) in metrics.items()})
+		return document
+
+	# Build an EMF document for each check, and for each operation each check called.
+	def emf_documents(self):
+		timestamp = int(time.time() * 1000)
+		with self.lock:
+			operations = sorted(self.operations.items())
+			wall_times = dict(self.wall_times)
+
+		totals = defaultdict(OperationStats)
+		for (check_name, operation), stats in operations:
+			metrics = {'Calls': (stats.calls, 'Count'), 'Memoized': (stats.memoized, 'Count'), 'Retries': (stats.retries, 'Count'), 'Throttles': (stats.throttles, 'Count'), 'Errors': (stats.errors, 'Count'), 'NotFound': (stats.not_found, 'Count')}
+			if stats.latencies:
+				metrics.update({'LatencyP{}'.format(percentile): (stats.latency(percentile), 'Milliseconds') for percentile in PERCENTILES})
+				metrics['LatencyMax'] = (max(stats.latencies) * 1000, 'Milliseconds')
+			yield self.emf_document({'Check': check_name, 'Operation': operation}, metrics, timestamp)
+
+			total = totals[check_name]
+			total.calls += stats.calls
+			total.retries += stats.retries
+			total.throttles += stats.throttles
+			total.errors += stats.errors
+			total.not_found += stats.not_found
+
+		for check_name in sorted(set(totals) | set(wall_times)):
+			total = totals[check_name]
+			metrics = {'Calls': (total.calls, 'Count'), 'Retries': (total.retries, 'Count'), 'Throttles': (total.throttles, 'Count'), 'Errors': (total.errors, 'Count'), 'NotFound': (total.not_found, 'Count')}
+			if check_name in wall_times:
+				metrics['WallTime'] = (wall_times[check_name], 'Seconds')
+			yield self.emf_document({'Check': check_name}, metrics, timestamp)
+
+	# Write our metrics as EMF documents, one per line, to --metrics-output.
+	def close(self):
+		path = self.bullkit.settings.metrics_output
+		stream = sys.stdout if path == '-' else open(path, 'w')
+		for document in self.emf_documents():
+			stream.write('{}\n'.format(json.dumps(document, sort_keys=True)))
+		if stream is sys.stdout:
+			stream.flush()
+		else:
+			stream.close()
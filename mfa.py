@@ -15,75 +15,115 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import boto3
-import yaml
+from bullkit import INCOMPLETE_MESSAGE
+import rules
+from sinks import Finding, Section
 
-def mfa(bullkit):
-	# Iterate through each IAM user.
-	bullkit.debug('Getting the list of IAM users...')
+# Work out whether an IAM user has a password but no MFA device.
+def lacks_mfa(inventory, user_name):
+	# If we have a credential report, it tells us without any per-user API calls.
+	credentials = inventory.credentials(user_name)
+	if credentials is not None:
+		if credentials.password_enabled and not credentials.mfa_active:
+			inventory.bullkit.debug('Password but no MFA found for: {}'.format(user_name))
+			return True
+		return False
+
+	# If the user has an MFA device, they're fine.
+	inventory.bullkit.debug('Checking IAM user: {}'.format(user_name))
+	if inventory.get('mfa devices', user_name):
+		return False
+	inventory.bullkit.debug('No MFA devices found for: {}'.format(user_name))
+
+	# Otherwise, they're "bad" if they have a password.
+	if inventory.get('login profile', user_name):
+		inventory.bullkit.debug('Password found for: {}'.format(user_name))
+		return True
+	inventory.bullkit.debug('No password found for: {}'.format(user_name))
+	return False
+
+# Collect the users who lack MFA into a list.
+def collect(inventory, bad_iam_users):
+	bad_iam_users = list(bad_iam_users)
+	inventory.bullkit.debug('List of AWS users without MFA assembled: {}'.format(bad_iam_users))
+	return bad_iam_users
+
+# The rule each IAM user must pass: if they have a password, they must have an MFA device.
+RULE = rules.Rule('mfa', 'users', ('credential report', 'users', 'mfa devices', 'login profile'), lacks_mfa, collect)
+
+# Check just the given IAM users again, e.g. because one of them has changed their MFA device. Users who no longer exist are fine.
+def rescan(bullkit, user_names):
+	return rules.scan(bullkit, [RULE], names=user_names)['mfa']
+
+# Work out whether a resource in our findings belongs to one of the given users.
+def covered(user_names, resource):
+	return resource in user_names
+
+# Combine the results of scanning several accounts, labelling each user with their account ID.
+def merge(results_by_account):
 	bad_iam_users = []
-	iam = boto3.resource('iam')
-	for iam_user in iam.users.all():
-		# If the user doesn't have an MFA device...
-		user_name = iam_user.name
-		bullkit.debug('Checking IAM user: {}'.format(user_name))
-		if not list(iam_user.mfa_devices.all()):
-			bullkit.debug('No MFA devices found for: {}'.format(user_name))
-
-			# Try to get the user's login profile. If we can, that means they have a password.
-			try:
-				# Note that the user is "bad" because they have a password but no MFA.
-				null = iam.LoginProfile(user_name).create_date
-				bullkit.debug('Password found for: {}'.format(user_name))
-				bad_iam_users.append(user_name)
-			except iam.meta.client.exceptions.NoSuchEntityException:
-				bullkit.debug('No password found for: {}'.format(user_name))
-	bullkit.debug('List of AWS users without MFA assembled: {}'.format(bad_iam_users))
-
-	# Format the list of users for Slack.
-	if bad_iam_users:
-		bad_iam_users_str = '\n'.join(bad_iam_users)
-		slackmsg = 'The following AWS users have not enabled multi factor authentication:\n```{}```\nThey should each visit http://docs.aws.amazon.com/IAM/latest/UserGuide/id_credentials_mfa_enable_virtual.html and perform the steps in the section titled: `Enable a Virtual MFA Device for an IAM User (AWS Management Console)`'.format(bad_iam_users_str)
-	else:
-		slackmsg = 'All AWS users have enabled multi factor authentication. Yay!'
-
-	# If we've been told to post to Slack...
-	if not bullkit.commandargs.parse_args().no_slack:
-		# Post the list to the relevant Slack channel.
-		bullkit.send_slack_message(bullkit.commandargs.parse_args().mfa_channel, 'AWS Security Bot', ':robot_face:', slackmsg)
-
-		# If there are users who need to enable MFA and we've been told to nag them...
-		if bad_iam_users and bullkit.commandargs.parse_args().mfa_nag_users:
-			# Load the map of AWS users to Slack users.
-			bullkit.debug('Trying to load the map of AWS users to Slack users...')
-			try:
-				with open('users.yml', 'r') as stream:
-					try:
-						slack_users = yaml.safe_load(stream)
-					except yaml.YAMLError as exc:
-						print(exc)
-			except IOError:
-				bullkit.debug('users.yml can\'t be read, so we\'ll skip messaging Slack users directly.')
-			bullkit.debug('Loaded:\n{}'.format(slack_users))
-
-			# Try to message each user directly via Slack.
-			if slack_users:
-				bullkit.debug('Iterating through bad AWS users to see if we can Slack them directly...')
-				for bad_iam_user in bad_iam_users:
-					if bad_iam_user in slack_users.keys():
-						if slack_users[bad_iam_user] is not False:
-							bad_slack_user = slack_users[bad_iam_user]
-							bullkit.debug('Trying to message @{}'.format())
-							slackmsg = 'Hi, it\'s me, your friendly AWS Security Bot! It looks like your AWS user (`{}`) doesn\'t have MFA (i.e. two-factor authentication) enabled. This is an important security feature that you should enable, so please visit http://docs.aws.amazon.com/IAM/latest/UserGuide/id_credentials_mfa_enable_virtual.html and perform the steps in the section titled: `Enable a Virtual MFA Device for an IAM User (AWS Management Console)`'.format(bad_iam_user)
-							bullkit.send_slack_message('@{}'.format(bad_slack_user), 'AWS Security Bot', ':robot_face:', slackmsg)
-						else:
-							bullkit.debug('Ignoring {} because it\'s set to False in users.yml.'.format(bad_iam_user))
-					else:
-						bullkit.debug('Couldn\'t find AWS user {} in the user map.'.format(bad_iam_user))
-						slackmsg='I don\'t know the Slack name of the AWS user `{}` so I could not send them a message directly. Please update my `users.yml` file so I can message them in the future.'.format(bad_iam_user)
-						bullkit.send_slack_message(bullkit.commandargs.parse_args().iam_keys_channel, 'AWS Security Bot', ':robot_face:', slackmsg)
+	for account_id, account_bad_iam_users in sorted(results_by_account.items()):
+		bad_iam_users.extend(['{}/{}'.format(account_id, bad_iam_user) for bad_iam_user in account_bad_iam_users])
+	return bad_iam_users
 
-	# If we've been told to *not* post to Slack...
+# Generate a finding for each user.
+def findings(bad_iam_users):
+	for bad_iam_user in bad_iam_users:
+		yield Finding('mfa', bad_iam_user, 'no mfa', {})
+
+# Narrow the results down to the given users.
+def select(bad_iam_users, resources):
+	resources = set(resources)
+	return [bad_iam_user for bad_iam_user in bad_iam_users if bad_iam_user in resources]
+
+# Report the IAM users who need to enable MFA. If we're given the users who've been resolved since the last report, only the changes are reported.
+def report(bullkit, bad_iam_users, resolved=None):
+	instructions = 'They should each visit http://docs.aws.amazon.com/IAM/latest/UserGuide/id_credentials_mfa_enable_virtual.html and perform the steps in the section titled: `Enable a Virtual MFA Device for an IAM User (AWS Management Console)`'
+
+	# Lay out the list of users for Slack.
+	sections = []
+	if resolved is not None:
+		if bad_iam_users:
+			sections.append(Section('Since my last report, I\'ve found these AWS users without multi factor authentication:', bad_iam_users, instructions))
+		if resolved:
+			sections.append(Section('These AWS users have enabled multi factor authentication (or been removed) since my last report:', resolved))
+	elif bad_iam_users:
+		sections.append(Section('The following AWS users have not enabled multi factor authentication:', bad_iam_users, instructions))
+	elif bullkit.was_cut_short('mfa'):
+		sections.append(Section('I didn\'t find any AWS users without multi factor authentication.'))
 	else:
-		# Print the list to standard output.
-		print(slackmsg)
+		sections.append(Section('All AWS users have enabled multi factor authentication. Yay!'))
+
+	# If we ran out of time, say that the list is incomplete.
+	if bullkit.was_cut_short('mfa'):
+		sections.append(Section(INCOMPLETE_MESSAGE))
+
+	# Post the list to the relevant Slack channel, split into several messages if it's long.
+	bullkit.post_report(bullkit.settings.mfa_channel, 'AWS users without MFA', sections)
+
+	# If we're posting to Slack, there are users who need to enable MFA and we've been told to nag them...
+	if not bullkit.settings.no_slack and bad_iam_users and bullkit.settings.mfa_nag_users:
+		# Load the map of AWS users to Slack users.
+		bullkit.debug('Trying to load the map of AWS users to Slack users...')
+		slack_users = bullkit.get_slack_users()
+		bullkit.debug('Loaded:\n{}'.format(slack_users))
+
+		# Try to message each user directly via Slack.
+		if slack_users:
+			bullkit.debug('Iterating through bad AWS users to see if we can Slack them directly...')
+			unknown_users = []
+			for bad_iam_user in bad_iam_users:
+				# Users from other accounts are labelled with their account ID, which isn't part of their name in users.yml.
+				iam_user_name = bad_iam_user.split('/')[-1]
+				if iam_user_name in slack_users.keys():
+					if slack_users[iam_user_name] is not False:
+						bad_slack_user = slack_users[iam_user_name]
+						bullkit.debug('Trying to message @{}'.format(bad_slack_user))
+						slackmsg = 'Hi, it\'s me, your friendly AWS Security Bot! It looks like your AWS user (`{}`) doesn\'t have MFA (i.e. two-factor authentication) enabled. This is an important security feature that you should enable, so please visit http://docs.aws.amazon.com/IAM/latest/UserGuide/id_credentials_mfa_enable_virtual.html and perform the steps in the section titled: `Enable a Virtual MFA Device for an IAM User (AWS Management Console)`'.format(bad_iam_user)
+						bullkit.send_slack_message(bullkit.slack_dm_channel(bad_slack_user), 'AWS Security Bot', ':robot_face:', slackmsg)
+					else:
+						bullkit.debug('Ignoring {} because it\'s set to False in users.yml.'.format(bad_iam_user))
+				else:
+					bullkit.debug('Couldn\'t find AWS user {} in the user map.'.format(bad_iam_user))
+					unknown_users.append(bad_iam_user)
+			bullkit.report_unknown_slack_users(bullkit.settings.mfa_channel, unknown_users)
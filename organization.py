@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import boto3
+import botocore.session
+from botocore.credentials import CredentialProvider, CredentialResolver, RefreshableCredentials
+from botocore.exceptions import BotoCoreError, ClientError
+import rules
+
+# Sessions for the roles we've assumed, keyed by role ARN. They're kept for as long as the process lives (e.g. between warm Lambda invocations), and botocore refreshes their credentials before they expire.
+sessions = {}
+sessions_lock = threading.Lock()
+
+# Provides the credentials of a role we've assumed, which botocore refreshes before they expire by assuming the role again.
+class AssumedRoleProvider(CredentialProvider):
+	METHOD = 'sts-assume-role'
+
+	def __init__(self, assume_role):
+		super().__init__()
+		self.assume_role = assume_role
+
+	def load(self):
+		return RefreshableCredentials.create_from_metadata(metadata=self.assume_role(), refresh_using=self.assume_role, method=self.METHOD)
+
+# Get the IDs of the accounts we've been asked to check.
+def account_ids(bullkit):
+	# If we've been given a list of accounts, use it.
+	if bullkit.settings.accounts:
+		return [account_id.strip() for account_id in bullkit.settings.accounts.split(',') if account_id.strip()]
+
+	# Otherwise, ask AWS Organizations for every active account.
+	bullkit.debug('Getting the list of accounts in our organization...')
+	account_ids = []
+	for page in bullkit.client('organizations').get_paginator('list_accounts').paginate():
+		account_ids.extend([account['Id'] for account in page['Accounts'] if account['Status'] == 'ACTIVE'])
+	return account_ids
+
+# Get a session for an account by assuming our role in it, reusing the session from an earlier call if there is one.
+def account_session(bullkit, account_id):
+	role_arn = 'arn:aws:iam::{}:role/{}'.format(account_id, bullkit.settings.assume_role_name)
+	with sessions_lock:
+		if role_arn in sessions:
+			return sessions[role_arn]
+
+	sts = bullkit.client('sts')
+
+	# Assume the role, returning its credentials in the form botocore uses to refresh them.
+	def assume_role():
+		bullkit.debug('Assuming role {}...'.format(role_arn))
+		credentials = sts.assume_role(RoleArn=role_arn, RoleSessionName='aws-security-bot')['Credentials']
+		return {'access_key': credentials['AccessKeyId'], 'secret_key': credentials['SecretAccessKey'], 'token': credentials['SessionToken'], 'expiry_time': credentials['Expiration'].isoformat()}
+
+	# Make the role our session's only source of credentials.
+	botocore_session = botocore.session.Session()
+	botocore_session.register_component('credential_provider', CredentialResolver([AssumedRoleProvider(assume_role)]))
+	session = boto3.session.Session(botocore_session=botocore_session, region_name=bullkit.session.region_name)
+
+	# If another thread beat us to it, use its session instead.
+	with sessions_lock:
+		return sessions.setdefault(role_arn, session)
+
+# Run the scanning half of each check against an account.
+def scan_account(bullkit, account_id, checks):
+	results = {}
+
+	# Don't start on the account if we've already run out of time.
+	if bullkit.past_deadline():
+		for check in checks:
+			bullkit.out_of_time(check.__name__)
+		return results
+
+	# Evaluate every check's rule against the account in one pass, so the data they share is only fetched once.
+	account_bullkit = bullkit.for_account(account_id, account_session(bullkit, account_id))
+	checks = [check for check in checks if not account_bullkit.out_of_time(check.__name__)]
+	bullkit.debug('Running {} against account {}...'.format(', '.join([check.__name__ for check in checks]), account_id))
+	rule_results = rules.scan(account_bullkit, [check.RULE for check in checks])
+	for check in checks:
+		results[check] = rule_results[check.__name__]
+
+	# Pass on which of the account's checks ran out of time.
+	for check_name in account_bullkit.cut_short:
+		bullkit.out_of_time(check_name)
+	return results
+
+# Scan every account in parallel, then report the combined results of each check once.
+def check_accounts(bullkit, checks):
+	results_by_check = {check: {} for check in checks}
+	failed_accounts = {}
+
+	my_account_ids = account_ids(bullkit)
+	workers = bullkit.settings.account_workers
+	bullkit.debug('Checking {} accounts with {} workers...'.format(len(my_account_ids), workers))
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = {executor.submit(scan_account, bullkit, account_id, checks): account_id for account_id in my_account_ids}
+		for future in as_completed(futures):
+			account_id = futures[future]
+			# Don't let one broken account stop us from reporting on the others.
+			try:
+				for check, result in future.result().items():
+					results_by_check[check][account_id] = result
+			except (BotoCoreError, ClientError) as exc:
+				failed_accounts[account_id] = exc
+
+	for check in checks:
+		# Leave out the accounts that are part way through a sweep that's spread over several runs, and only report if there's an account left.
+		results_by_account = {account_id: results for account_id, results in results_by_check[check].items() if results is not None}
+		if results_by_account or not results_by_check[check]:
+			with bullkit.checking(check.__name__):
+				bullkit.report(check, check.merge(results_by_account), complete=not failed_accounts and len(results_by_account) == len(my_account_ids))
+
+	if failed_accounts:
+		bullkit.stderr('Couldn\'t check these accounts:\n{}'.format('\n'.join(['{}: {}'.format(account_id, exc) for account_id, exc in sorted(failed_accounts.items())])))
@@ -15,46 +15,117 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import boto3
+from bullkit import INCOMPLETE_MESSAGE
+from inventory import NO_PUBLIC_ACCESS_BLOCK
+from sinks import Finding, Section
+import rules
 
-def publics3 (bullkit):
+# The permission we report for buckets that are public because of their bucket policy rather than their ACL.
+PUBLIC_POLICY_PERMISSION = 'PUBLIC_POLICY'
+
+# If the account ignores public ACLs and restricts public policies, no bucket can be public, so there's no need to check them one by one.
+def account_allows_public_buckets(inventory):
+	account_block = inventory.get('account public access block')
+	if account_block['IgnorePublicAcls'] and account_block['RestrictPublicBuckets']:
+		inventory.bullkit.debug('Public access is blocked for the whole account, so we\'ll skip checking each bucket.')
+		return False
+	return True
+
+# Get the list of permissions that a bucket grants to the public, taking the account's public access block into account.
+def public_permissions(inventory, bucket_name):
+	# A setting is in effect if either the account or the bucket enables it.
+	account_block = inventory.get('account public access block')
+	bucket_block = inventory.get('bucket public access block', bucket_name)
+	block = {setting: account_block[setting] or bucket_block[setting] for setting in NO_PUBLIC_ACCESS_BLOCK}
+
+	# If public ACLs are ignored and public policies are restricted, the bucket can't be public.
+	if block['IgnorePublicAcls'] and block['RestrictPublicBuckets']:
+		inventory.bullkit.debug('Public access to {} is blocked.'.format(bucket_name))
+		return []
+
+	permissions = []
+
+	# Unless public policies are restricted, ask S3 whether the bucket's policy makes it public.
+	if not block['RestrictPublicBuckets'] and inventory.get('bucket policy status', bucket_name):
+		inventory.bullkit.debug('Oh no, the policy of {} makes it public!'.format(bucket_name))
+		permissions.append(PUBLIC_POLICY_PERMISSION)
+
+	# Unless public ACLs are ignored, fall back to checking the bucket's ACL grants.
+	if not block['IgnorePublicAcls']:
+		public_grants = inventory.get('bucket acl', bucket_name)
+		if public_grants:
+			inventory.bullkit.debug('Oh no, {} is public!'.format(bucket_name))
+		permissions.extend(public_grants)
+
+	return permissions
+
+# Collect the public buckets into a dict of their names to their public permissions, ordered by name.
+def collect(inventory, bad_buckets):
+	return dict(bad_buckets)
+
+# The rule each S3 bucket must pass: it mustn't grant any permissions to the public. Buckets are checked by a pool of --public-s3-workers, and spread over several runs with --checkpoint-store.
+RULE = rules.Rule('publics3', 'buckets', ('account id', 'account public access block', 'buckets', 'bucket public access block', 'bucket policy status', 'bucket acl'), public_permissions, collect, applies=account_allows_public_buckets, sweep=True, workers=lambda settings: settings.public_s3_workers)
+
+# Check just the given S3 buckets again, e.g. because one of their ACLs has changed. Buckets that no longer exist aren't public.
+def rescan(bullkit, bucket_names):
+	return rules.scan(bullkit, [RULE], names=bucket_names)['publics3']
+
+# Work out whether a resource in our findings is one of the given buckets.
+def covered(bucket_names, resource):
+	return resource in bucket_names
+
+# Combine the results of scanning several accounts, labelling each bucket with its account ID.
+def merge(results_by_account):
 	bad_buckets = {}
-	bullkit.debug('Getting the list of S3 buckets...')
-	s3 = boto3.resource('s3')
-	for bucket in s3.buckets.all():
-		bullkit.debug('Checking the ACL of: {}'.format(bucket.name))
-		for grant in s3.BucketAcl(bucket.name).grants:
-			if grant['Grantee']['Type'] == 'Group' and 'URI' in grant['Grantee'].keys():
-				if grant['Grantee']['URI'] in ['http://acs.amazonaws.com/groups/global/AllUsers', 'http://acs.amazonaws.com/groups/global/AuthenticatedUsers']:
-					if not bad_buckets.get(bucket.name):
-						bullkit.debug('Oh no, it\'s public!')
-						bad_buckets[bucket.name] = []
-					bad_buckets[bucket.name].append(grant['Permission'])
+	for account_id, account_bad_buckets in sorted(results_by_account.items()):
+		for bucket_name, permissions in account_bad_buckets.items():
+			bad_buckets['{}/{}'.format(account_id, bucket_name)] = permissions
+	return bad_buckets
+
+# Generate a finding for each public bucket. A bucket's finding changes if its public permissions do.
+def findings(bad_buckets):
+	for bucket_name, permissions in bad_buckets.items():
+		yield Finding('publics3', bucket_name, ', '.join(sorted(set(permissions))), {'permissions': permissions})
+
+# Narrow the results down to the given buckets.
+def select(bad_buckets, resources):
+	return {bucket_name: bad_buckets[bucket_name] for bucket_name in sorted(resources)}
+
+# Format each bucket and its permissions as a line for Slack.
+def bucket_lines(bad_buckets):
+	return ['{}: {}'.format(bucket, privs) for bucket, privs in bad_buckets.items()]
+
+# Report the public S3 buckets. If we're given the buckets that have been resolved since the last report, only the changes are reported.
+def report(bullkit, bad_buckets, resolved=None):
+	sections = []
+
+	# If we're only reporting what's changed since the last report...
+	if resolved is not None:
+		if bad_buckets:
+			bullkit.debug('Found these newly public buckets: {}'.format(bad_buckets))
+			sections.append(Section('Since my last report, the following S3 buckets have become public or changed their public permissions:', bucket_lines(bad_buckets), 'You should adjust their permissions immediately.'))
+		if resolved:
+			sections.append(Section('These S3 buckets are no longer public (or have been deleted) since my last report:', resolved))
 
 	# If we didn't find any public buckets...
-	if not bad_buckets:
+	elif not bad_buckets:
 		bullkit.debug('Found no public buckets.')
-		slackmsg = 'No S3 buckets have public permissions. Yay!'
+		if bullkit.was_cut_short('publics3'):
+			sections.append(Section('I didn\'t find any S3 buckets with public permissions.'))
+		else:
+			sections.append(Section('No S3 buckets have public permissions. Yay!'))
 	
 	# If we found public buckets...
 	else:
-		# Format the list into a string for a Slack message.
+		# Lay out the list for Slack.
 		bullkit.debug('Found these public buckets: {}'.format(bad_buckets))
 		bullkit.debug('Formatting the list of bad buckets...')
-		bad_buckets_list = []
-		for bucket, privs in bad_buckets.items():
-			bad_bucket = '{}: {}'.format(bucket, privs)
-			bad_buckets_list.append(bad_bucket)
-		bad_buckets_str = '\n'.join(bad_buckets_list)
-		slackmsg = 'The following S3 buckets are public:\n```{}```\nYou should adjust their permissions immediately.'.format(bad_buckets_str)
-
-	# If we've been told to post to Slack...
-	if not bullkit.commandargs.parse_args().no_slack:
-		# Post the list to the relevant Slack channel.
-		bullkit.debug('Posting our findings to Slack...')
-		bullkit.send_slack_message(bullkit.commandargs.parse_args().public_s3_channel, 'AWS Security Bot', ':robot_face:', slackmsg)
-
-	# If we've been told to *not* post to Slack...
-	else:
-		# Print the list to standard output.
-		print(slackmsg)
+		sections.append(Section('The following S3 buckets are public:', bucket_lines(bad_buckets), 'You should adjust their permissions immediately.'))
+
+	# If we ran out of time, say that the list is incomplete.
+	if bullkit.was_cut_short('publics3'):
+		sections.append(Section(INCOMPLETE_MESSAGE))
+
+	# Post the list to the relevant Slack channel, split into several messages if it's long.
+	bullkit.debug('Posting our findings...')
+	bullkit.post_report(bullkit.settings.public_s3_channel, 'Public S3 buckets', sections)
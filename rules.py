@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+import checkpoint
+import inventory
+
+# A check's rule, which is evaluated for each resource (user or bucket) in an account.
+# - check_name: the check the rule belongs to.
+# - resource: what it's evaluated for, 'users' or 'buckets'.
+# - needs: the inventory datasets it uses (see inventory.DATASETS), which are each fetched once however many rules use them.
+# - evaluate(inventory, name): works out a resource's finding, which is falsy if there's nothing wrong with it. If the rule is swept, it must be JSON-serializable.
+# - collect(inventory, values): turns a dict of resource names to findings into the check's results.
+# - applies(inventory): says whether the rule needs evaluating at all (e.g. no bucket can be public if the account blocks public access). Optional.
+# - sweep: whether the rule's resources are spread over several runs with --checkpoint-store.
+# - workers(settings): how many workers the rule brings to evaluating its resources concurrently. Optional, and defaults to 1.
+Rule = namedtuple('Rule', ['check_name', 'resource', 'needs', 'evaluate', 'collect', 'applies', 'sweep', 'workers'])
+Rule.__new__.__defaults__ = (None, False, None)
+
+# Error codes that mean a resource no longer exists, e.g. because it was deleted after we listed it. There's nothing wrong with a resource that doesn't exist.
+MISSING_RESOURCE_CODES = ('NoSuchEntity', 'NoSuchBucket')
+
+# Evaluate one rule for one resource, counting its calls against its check. Returns None if we've run out of time for the check.
+def evaluate(bullkit, my_inventory, rule, name):
+	if bullkit.out_of_time(rule.check_name):
+		return None
+	with bullkit.checking(rule.check_name, timed=False):
+		try:
+			return rule.evaluate(my_inventory, name)
+		except ClientError as exc:
+			if exc.response['Error']['Code'] not in MISSING_RESOURCE_CODES:
+				raise
+			bullkit.debug('{} no longer exists.'.format(name))
+			return False
+
+# Evaluate every rule that applies to a kind of resource in one pass over the resources, so the data each resource needs is fetched once and shared by all of the rules. Returns a dict of each rule's check name to a dict of the resources it was evaluated for to their findings.
+def evaluate_all(bullkit, my_inventory, resource, resource_rules, names):
+	values = {rule.check_name: {} for rule in resource_rules}
+	started = time.time()
+
+	# Evaluate the rules for a resource, then forget the data we fetched for it, since no other rule needs it. Rules that are swept only look at the resources that are pending in this run.
+	resource_datasets = sorted(set([dataset for rule in resource_rules for dataset in rule.needs if inventory.DATASETS[dataset] != 'account']))
+	def evaluate_resource(name):
+		results = [(rule, evaluate(bullkit, my_inventory, rule, name)) for rule in resource_rules if name in names[rule.check_name]]
+		my_inventory.forget(resource_datasets, name)
+		return results
+
+	# Each rule brings its own workers to the pass, so evaluating rules together is as concurrent as evaluating them separately.
+	resource_names = sorted(set().union(*names.values()))
+	workers = sum([rule.workers(bullkit.settings) if rule.workers else 1 for rule in resource_rules])
+	bullkit.debug('Evaluating {} for {} {} with {} workers...'.format(', '.join([rule.check_name for rule in resource_rules]), len(resource_names), resource, workers))
+	if workers > 1:
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			evaluated = list(executor.map(evaluate_resource, resource_names))
+	else:
+		evaluated = [evaluate_resource(name) for name in resource_names]
+
+	# Leave out the resources we ran out of time to evaluate.
+	for name, results in zip(resource_names, evaluated):
+		for rule, value in results:
+			if value is not None:
+				values[rule.check_name][name] = value
+
+	for rule in resource_rules:
+		bullkit.record_wall_time(rule.check_name, time.time() - started)
+	return values
+
+# Evaluate the given rules against an account in a single pass over each kind of resource, and return a dict of each check's name to its results. A check's results are None if it's part way through a sweep that's spread over several runs.
+# If we're given the names of some resources, only they are evaluated (e.g. because an event says they've changed), without the credential report, which may be out of date, and without sweeping.
+def scan(bullkit, rules, names=None, my_inventory=None):
+	my_inventory = my_inventory or inventory.AccountInventory(bullkit, use_credential_report=names is None)
+	results = {}
+
+	# Leave out the rules that don't need evaluating.
+	applicable_rules = []
+	for rule in rules:
+		if rule.applies and not rule.applies(my_inventory):
+			results[rule.check_name] = rule.collect(my_inventory, {})
+		else:
+			applicable_rules.append(rule)
+
+	# Fetch the account-wide data the rules need up front, so the workers don't wait for each other to fetch it. If we've been given the resources to evaluate, we don't need the lists of every user and bucket.
+	needs = sorted(set([dataset for rule in applicable_rules for dataset in rule.needs]))
+	if names is not None:
+		needs = [dataset for dataset in needs if dataset not in set([rule.resource for rule in applicable_rules])]
+	bullkit.debug('The rules for {} need: {}'.format(', '.join([rule.check_name for rule in applicable_rules]) or 'nothing', ', '.join(needs) or 'nothing'))
+	for dataset in needs:
+		if inventory.DATASETS[dataset] == 'account':
+			my_inventory.get(dataset)
+
+	# Work out which resources each rule should be evaluated for.
+	resource_names = {}
+	sweeps = {}
+	for rule in applicable_rules:
+		if names is not None:
+			resource_names[rule.check_name] = set(names)
+			continue
+		rule_names = my_inventory.get(rule.resource)
+		# If we're spreading the rule over several runs, only evaluate the resources that are pending in this one.
+		if rule.sweep and bullkit.settings.checkpoint_store:
+			sweeps[rule.check_name] = checkpoint.ShardedSweep(bullkit, rule.check_name, rule_names)
+			rule_names = sweeps[rule.check_name].pending
+		resource_names[rule.check_name] = set(rule_names)
+
+	# Evaluate the rules, one pass for each kind of resource. The passes don't share any data, so run them concurrently.
+	resources = sorted(set([rule.resource for rule in applicable_rules]))
+	def evaluate_resources(resource):
+		resource_rules = [rule for rule in applicable_rules if rule.resource == resource]
+		return evaluate_all(bullkit, my_inventory, resource, resource_rules, {rule.check_name: resource_names[rule.check_name] for rule in resource_rules})
+	values = {}
+	if resources:
+		with ThreadPoolExecutor(max_workers=len(resources)) as executor:
+			for resource_values in executor.map(evaluate_resources, resources):
+				values.update(resource_values)
+	my_inventory.save()
+
+	for rule in applicable_rules:
+		rule_values = values[rule.check_name]
+		# If we're spreading the rule over several runs, save our progress, and only carry on once the whole sweep is done.
+		sweep = sweeps.get(rule.check_name)
+		if sweep:
+			sweep.record(rule_values)
+			rule_values = sweep.finish()
+			if rule_values is None:
+				results[rule.check_name] = None
+				continue
+		results[rule.check_name] = rule.collect(my_inventory, {name: value for name, value in sorted(rule_values.items()) if value})
+	return results
@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import hmac
+import json
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from bullkit import Bullkit
+import inventory
+
+# How old (in seconds) a Slack request may be before we refuse it, so a captured request can't be replayed later.
+SLACK_REQUEST_MAX_AGE = 300
+
+# What we tell Slack users who ask us something we don't understand.
+SLASH_COMMAND_HELP = 'Ask me `bucket <name>` to see if an S3 bucket is public, `keys <user>` to see which of an IAM user\'s access keys expire this month, or `mfa` to list the users without MFA.'
+
+# Keeps an inventory of the account in memory, refreshing it in the background, and answers questions about it.
+class InventoryServer:
+	def __init__(self, settings, session=None, scan=inventory.scan):
+		# Each refresh is a complete scan, so it doesn't make sense to spread it over several runs or only report what's changed.
+		self.settings = settings._replace(checkpoint_store=None, findings_store=None)
+		self.session = session
+		self.scan = scan
+		self.inventory = None
+		self.refreshed = threading.Event()
+		self.stopped = threading.Event()
+
+	# Build a fresh inventory and start answering from it. A new Bullkit is used each time, so none of the last scan's responses are reused. If the scan fails, we keep answering from the old inventory.
+	def refresh(self):
+		bullkit = Bullkit(self.settings, session=self.session)
+		bullkit.debug('Refreshing the inventory...')
+		started = time.time()
+		try:
+			self.inventory = self.scan(bullkit)
+		except Exception as exc:
+			bullkit.stderr('Couldn\'t refresh the inventory, so we\'ll keep using the old one: {}'.format(exc))
+			return
+		self.refreshed.set()
+		bullkit.debug('Refreshed the inventory in {:.1f} seconds.'.format(time.time() - started))
+
+	# Refresh the inventory every --serve-refresh minutes until we're stopped.
+	def refresh_forever(self):
+		while not self.stopped.is_set():
+			self.refresh()
+			self.stopped.wait(self.settings.serve_refresh * 60)
+
+	def stop(self):
+		self.stopped.set()
+
+	# Answer a query about the inventory with an HTTP status and a JSON-able result.
+	def status(self):
+		my_inventory = self.inventory
+		if my_inventory is None:
+			return 503, {'error': 'The inventory hasn\'t been built yet.'}
+		return 200, {'scanned at': datetime.fromtimestamp(my_inventory.scanned_at, timezone.utc).isoformat(), 'age': time.time() - my_inventory.scanned_at, 'users': len(my_inventory.access_keys), 'buckets': len(my_inventory.bucket_names)}
+
+	def bucket(self, my_inventory, bucket_name):
+		permissions = my_inventory.bucket_permissions(bucket_name)
+		if permissions is None:
+			return 404, {'error': 'There\'s no bucket called {}.'.format(bucket_name)}
+		return 200, {'bucket': bucket_name, 'public': bool(permissions), 'permissions': permissions}
+
+	# A user's active access keys and when they expire. If we're given a number of days (or 'month'), only the keys that expire before then are included, including those that already have.
+	def user_keys(self, my_inventory, user_name, expiring=None):
+		if not self.settings.iam_keys_expire_age:
+			return 400, {'error': '--iam-keys-expire-age must be specified to ask when access keys expire.'}
+		key_expirations = my_inventory.key_expirations(user_name, self.settings.iam_keys_expire_age)
+		if key_expirations is None:
+			return 404, {'error': 'There\'s no IAM user called {}.'.format(user_name)}
+
+		now = datetime.now(timezone.utc)
+		if expiring == 'month':
+			cutoff = (now.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+			key_expirations = [(access_key, expires) for access_key, expires in key_expirations if expires < cutoff]
+		elif expiring is not None:
+			try:
+				cutoff = now + timedelta(days=float(expiring))
+			except ValueError:
+				return 400, {'error': 'expiring must be a number of days or month.'}
+			key_expirations = [(access_key, expires) for access_key, expires in key_expirations if expires < cutoff]
+		return 200, {'user': user_name, 'keys': [{'id': access_key.id, 'created': access_key.created.isoformat(), 'expires': expires.isoformat(), 'expired': expires <= now} for access_key, expires in key_expirations]}
+
+	def users_without_mfa(self, my_inventory):
+		return 200, {'users': my_inventory.users_without_mfa}
+
+	# Work out which query an HTTP GET is asking, and answer it.
+	def get(self, path, query):
+		parts = [unquote(part) for part in path.strip('/').split('/')]
+		if parts == ['status']:
+			return self.status()
+		my_inventory = self.inventory
+		if my_inventory is None:
+			return self.status()
+		if len(parts) == 2 and parts[0] == 'buckets':
+			return self.bucket(my_inventory, parts[1])
+		if len(parts) == 3 and parts[0] == 'users' and parts[2] == 'keys':
+			return self.user_keys(my_inventory, parts[1], query.get('expiring', [None])[0])
+		if parts == ['users'] and query.get('mfa') == ['false']:
+			return self.users_without_mfa(my_inventory)
+		return 404, {'error': 'Unknown query. Try /buckets/<name>, /users/<name>/keys?expiring=month or /users?mfa=false.'}
+
+	# Answer a Slack slash command, e.g. "/secbot bucket my-bucket", with a message.
+	def slash_command(self, text):
+		words = text.split()
+		command = words[0].lower() if words else ''
+		if command not in ('bucket', 'keys', 'mfa') or (command != 'mfa' and len(words) != 2):
+			return SLASH_COMMAND_HELP
+		my_inventory = self.inventory
+		if my_inventory is None:
+			return 'I\'m still building my inventory, so ask me again in a few minutes.'
+		as_of = '_(as of {:.0f} minutes ago)_'.format((time.time() - my_inventory.scanned_at) / 60)
+
+		if command == 'bucket':
+			status, result = self.bucket(my_inventory, words[1])
+			if status != 200:
+				return '{} {}'.format(result['error'], as_of)
+			if not result['public']:
+				return 'The S3 bucket `{}` isn\'t public. {}'.format(words[1], as_of)
+			return 'The S3 bucket `{}` is public: {} {}'.format(words[1], ', '.join(result['permissions']), as_of)
+
+		if command == 'keys':
+			status, result = self.user_keys(my_inventory, words[1], 'month')
+			if status != 200:
+				return '{} {}'.format(result['error'], as_of)
+			if not result['keys']:
+				return 'None of {}\'s access keys expire this month. {}'.format(words[1], as_of)
+			lines = ['{} {} {}'.format(access_key['id'], 'expired' if access_key['expired'] else 'expires', access_key['expires'][:10]) for access_key in result['keys']]
+			return '{}\'s access keys that expire by the end of this month: {}\n```{}```'.format(words[1], as_of, '\n'.join(lines))
+
+		if not my_inventory.users_without_mfa:
+			return 'All AWS users have enabled multi factor authentication. Yay! {}'.format(as_of)
+		return 'These AWS users have not enabled multi factor authentication: {}\n```{}```'.format(as_of, '\n'.join(my_inventory.users_without_mfa))
+
+	# Check that a request came from Slack, if we've been given a signing secret to check it with.
+	def verify_slack_request(self, headers, body):
+		if not self.settings.slack_signing_secret:
+			return True
+		timestamp = headers.get('X-Slack-Request-Timestamp', '')
+		try:
+			if abs(time.time() - int(timestamp)) > SLACK_REQUEST_MAX_AGE:
+				return False
+		except ValueError:
+			return False
+		expected = 'v0=' + hmac.new(self.settings.slack_signing_secret.encode('utf-8'), b'v0:' + timestamp.encode('utf-8') + b':' + body, hashlib.sha256).hexdigest()
+		return hmac.compare_digest(expected, headers.get('X-Slack-Signature', ''))
+
+# Handles HTTP requests by passing them to the server's InventoryServer.
+class RequestHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		url = urlparse(self.path)
+		self.respond(*self.server.inventory_server.get(url.path, parse_qs(url.query)))
+
+	def do_POST(self):
+		if urlparse(self.path).path.rstrip('/') != '/slack':
+			self.respond(404, {'error': 'Slash commands should be sent to /slack.'})
+			return
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		if not self.server.inventory_server.verify_slack_request(self.headers, body):
+			self.respond(401, {'error': 'The request isn\'t signed by Slack.'})
+			return
+		text = parse_qs(body.decode('utf-8')).get('text', [''])[0]
+		self.respond(200, {'response_type': 'ephemeral', 'text': self.server.inventory_server.slash_command(text)})
+
+	def respond(self, status, result):
+		body = json.dumps(result, sort_keys=True).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	# Only log requests if we're being verbose.
+	def log_message(self, format, *args):
+		if self.server.inventory_server.settings.v:
+			BaseHTTPRequestHandler.log_message(self, format, *args)
+
+# Make the HTTP server for an InventoryServer, without starting it.
+def http_server(inventory_server):
+	httpd = ThreadingHTTPServer((inventory_server.settings.serve_address, inventory_server.settings.serve_port), RequestHandler)
+	httpd.daemon_threads = True
+	httpd.inventory_server = inventory_server
+	return httpd
+
+# Keep an inventory of the account and answer queries about it over HTTP until we're interrupted.
+def serve(settings, session=None, scan=inventory.scan):
+	inventory_server = InventoryServer(settings, session=session, scan=scan)
+	threading.Thread(target=inventory_server.refresh_forever, daemon=True).start()
+	httpd = http_server(inventory_server)
+	sys.stderr.write('Answering queries on http://{}:{}/ ...\n'.format(*httpd.server_address[:2]))
+	try:
+		httpd.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		inventory_server.stop()
+		httpd.server_close()
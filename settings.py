@@ -0,0 +1,189 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+from collections import namedtuple
+import configargparse
+
+# Make the parser for our command line options, which may also be given in environment variables.
+def argument_parser():
+	commandargs = configargparse.ArgumentParser(description='This script performs various security checks on an Amazon Web Services account.')
+	commandargs.add_argument('-v', env_var='VERBOSE', action="store_true", default=False, help='Print additional debugging output to stderr.')
+	commandargs.add_argument('--no-slack', env_var='NO_SLACK', action="store_true", default=False, help='Print output to stdout rather than Slack.')
+	commandargs.add_argument('--slack-token', env_var='SLACK_TOKEN', help='Your Slack API token. Required unless you use --no-slack.')
+	commandargs.add_argument('--slack-workers', env_var='SLACK_WORKERS', type=int, default=4, help='The number of Slack messages to send concurrently, within Slack\'s rate limits. Defaults to 4.')
+	commandargs.add_argument('--slack-api-url', env_var='SLACK_API_URL', default='https://slack.com/api/', help='The base URL of the Slack Web API. Defaults to https://slack.com/api/.')
+	commandargs.add_argument('--slack-directory-ttl', env_var='SLACK_DIRECTORY_TTL', type=float, default=24, help='The age (in hours) after which the cached Slack user directory is fetched again. Defaults to 24.')
+	commandargs.add_argument('--slack-message-size', env_var='SLACK_MESSAGE_SIZE', type=int, default=3500, help='The maximum number of characters in a Slack message, at least 100. Longer reports are split over several messages. Defaults to 3500.')
+	commandargs.add_argument('--slack-upload-size', env_var='SLACK_UPLOAD_SIZE', type=int, default=20000, help='Reports longer than this many characters are uploaded to Slack as a file rather than split into messages. Defaults to 20000.')
+	commandargs.add_argument('--findings-output', env_var='FINDINGS_OUTPUT', help='Write every finding as a line of JSON to this file, or to stdout if it\'s -.')
+	commandargs.add_argument('--sinks', env_var='SINKS', help='A comma-separated list of where findings and reports go: summary (a count of each check\'s findings on stderr), json (--findings-output), slack, text (reports printed to stdout), or the dotted name of a sink class to import, e.g. mysinks.TicketSink. Defaults to summary, json if --findings-output is given, and slack, or text with --no-slack.')
+	commandargs.add_argument('--metrics-output', env_var='METRICS_OUTPUT', help='At the end of the run, write metrics about each check\'s wall time and its AWS and Slack calls (counts, latency percentiles, retries and throttles) in CloudWatch Embedded Metric Format to this file, or to stdout if it\'s -.')
+	commandargs.add_argument('--metrics-namespace', env_var='METRICS_NAMESPACE', default='AWSSecurityBot', help='The CloudWatch namespace for --metrics-output. Defaults to AWSSecurityBot.')
+	commandargs.add_argument('--cache-dir', env_var='CACHE_DIR', default='/tmp/aws-security-bot', help='The directory in which to keep data that can be reused by later runs, such as the regions of S3 buckets. Defaults to /tmp/aws-security-bot.')
+	commandargs.add_argument('--aws-max-pool-connections', env_var='AWS_MAX_POOL_CONNECTIONS', type=int, default=25, help='The number of connections each AWS client keeps open for concurrent requests. Defaults to 25.')
+	commandargs.add_argument('--aws-retry-mode', env_var='AWS_RETRY_MODE', default='adaptive', help='How AWS clients retry failed requests: legacy, standard or adaptive, which also slows down when AWS throttles us. Defaults to adaptive.')
+	commandargs.add_argument('--aws-max-attempts', env_var='AWS_MAX_ATTEMPTS', type=int, default=5, help='How many times AWS clients try each request before giving up. Defaults to 5.')
+	commandargs.add_argument('--aws-requests-per-second', env_var='AWS_REQUESTS_PER_SECOND', type=float, default=0, help='The maximum number of requests per second to send to AWS for each account, shared by every check. Defaults to 0, which means no limit.')
+	commandargs.add_argument('--deadline-margin', env_var='DEADLINE_MARGIN', type=float, default=15, help='When running in Lambda, stop starting new work this many seconds before the function times out, so there\'s time left to report what we\'ve found. Defaults to 15.')
+	commandargs.add_argument('--checkpoint-store', env_var='CHECKPOINT_STORE', help='Spread the --public-s3 and --iam-keys scans over several runs, saving their progress to this local directory or S3 location (s3://bucket/prefix) between runs. Their results are reported when a full sweep is complete.')
+	commandargs.add_argument('--shards', env_var='SHARDS', type=int, default=1, help='The number of shards to split a --checkpoint-store sweep into. Each run checks at most one shard. Defaults to 1.')
+	commandargs.add_argument('--findings-store', env_var='FINDINGS_STORE', help='Keep the findings of each run in this SQLite database file or S3 object (s3://bucket/key), and only report findings that are new, have changed or have been resolved since the last run.')
+	commandargs.add_argument('--full-digest-days', env_var='FULL_DIGEST_DAYS', type=float, default=7, help='When using --findings-store, report every finding anyway if it\'s been this many days since the last full report. Defaults to 7.')
+	commandargs.add_argument('--accounts', env_var='ACCOUNTS', help='A comma-separated list of AWS account IDs to check by assuming --assume-role-name in each of them, instead of checking the account we\'re running in.')
+	commandargs.add_argument('--organization-accounts', env_var='ORGANIZATION_ACCOUNTS', action="store_true", default=False, help='Check every active account in our AWS Organization by assuming --assume-role-name in each of them, instead of checking the account we\'re running in.')
+	commandargs.add_argument('--assume-role-name', env_var='ASSUME_ROLE_NAME', help='The name of the IAM role to assume in each account. Required if you use --accounts or --organization-accounts.')
+	commandargs.add_argument('--account-workers', env_var='ACCOUNT_WORKERS', type=int, default=10, help='The number of accounts to check concurrently. Defaults to 10.')
+	commandargs.add_argument('--event-file', env_var='EVENT_FILE', help='Rather than checking everything, only check the IAM users and S3 buckets affected by the CloudTrail events in this JSON file: a single event, an EventBridge event, a batch of messages from SQS, or a CloudTrail log file.')
+	commandargs.add_argument('--serve', env_var='SERVE', action="store_true", default=False, help='Rather than running the checks once, keep an inventory of IAM users, access keys and S3 buckets in memory, refresh it in the background, and answer queries about it over HTTP and as a Slack slash command.')
+	commandargs.add_argument('--serve-address', env_var='SERVE_ADDRESS', default='127.0.0.1', help='The address on which --serve listens. Defaults to 127.0.0.1.')
+	commandargs.add_argument('--serve-port', env_var='SERVE_PORT', type=int, default=8080, help='The port on which --serve listens. Defaults to 8080.')
+	commandargs.add_argument('--serve-refresh', env_var='SERVE_REFRESH', type=float, default=15, help='How often (in minutes) --serve refreshes its inventory. Defaults to 15.')
+	commandargs.add_argument('--slack-signing-secret', env_var='SLACK_SIGNING_SECRET', help='The signing secret of your Slack app, used by --serve to check that slash commands come from Slack. If it isn\'t given, slash commands aren\'t checked.')
+	commandargs.add_argument('--mfa', env_var='MFA', action="store_true", default=False, help='Check for IAM users that don\'t have MFA enabled.')
+	commandargs.add_argument('--mfa-channel', env_var='MFA_CHANNEL', help='The Slack channel to which we should post the results of the IAM user MFA check.')
+	commandargs.add_argument('--mfa-nag-users', env_var='MFA_NAG_USERS', action="store_true", default=False, help='Send Slack messages directly to users who need to enable MFA. Relies on a properly populated users.yml file.')
+	commandargs.add_argument('--public-s3', env_var='PUBLIC_S3', action="store_true", default=False, help='Check for public S3 buckets.')
+	commandargs.add_argument('--public-s3-channel', env_var='PUBLIC_S3_CHANNEL', help='The Slack channel to which we should post the results of the public S3 bucket check.')
+	commandargs.add_argument('--public-s3-workers', env_var='PUBLIC_S3_WORKERS', type=int, default=1, help='The number of S3 bucket ACLs to fetch concurrently. Defaults to 1.')
+	commandargs.add_argument('--iam-keys', env_var='IAM_KEYS', action="store_true", default=False, help='Check for expired IAM access keys.')
+	commandargs.add_argument('--iam-keys-channel', env_var='IAM_KEYS_CHANNEL', help='The Slack channel to which we should post the results of the expired IAM access key check.')
+	commandargs.add_argument('--iam-keys-nag-users', env_var='IAM_KEYS_NAG_USERS', action="store_true", default=False, help='Send Slack messages directly to users who need to disable expired IAM access keys. Relies on a properly populated users.yml file.')
+	commandargs.add_argument('--iam-keys-warn-age', env_var='IAM_KEYS_WARN_AGE', type=int, help='The age (in days) of IAM access keys after which we should start sending warnings.')
+	commandargs.add_argument('--iam-keys-expire-age', env_var='IAM_KEYS_EXPIRE_AGE', type=int, help='The age (in days) that IAM access keys are not allowed to exceed.')
+	commandargs.add_argument('--credential-report', env_var='CREDENTIAL_REPORT', action="store_true", default=False, help='Read IAM users\' passwords, MFA and access key states from the IAM credential report rather than making API calls for every user.')
+	commandargs.add_argument('--credential-report-max-age', env_var='CREDENTIAL_REPORT_MAX_AGE', type=float, default=4, help='The age (in hours) after which the credential report is considered stale and per-user API calls are used instead. Defaults to 4.')
+	return commandargs
+
+# Function for outputting fatal error messages.
+def abort(message):
+	sys.stderr.write('{}\n'.format(message))
+	quit()
+
+# Parse and validate our options once, returning them as an immutable settings object that's shared by everything in the run. Options that aren't given on the command line are read from the environment.
+def load(args=None):
+	parsed_args = vars(argument_parser().parse_args(args))
+	settings = namedtuple('Settings', sorted(parsed_args))(**parsed_args)
+	validate(settings)
+	return settings
+
+# Fail if the settings don't make sense together.
+def validate(settings):
+	# If we're supposed to post to Slack (which we never do when serving, since the server only answers slash commands)...
+	if not settings.no_slack and not settings.serve:
+		# ...fail if the API token hasn't been provided.
+		if not settings.slack_token:
+			abort('--slack-token must be specified if you\'re not suppressing Slack output with --no-slack')
+
+		# ...fail if the number of workers isn't positive.
+		if settings.slack_workers < 1:
+			abort('--slack-workers must be a positive integer')
+
+		# ...fail if the message size is too small to fit a line of a report alongside the marker for a continued message, or the upload size isn't positive.
+		if settings.slack_message_size < 100:
+			abort('--slack-message-size must be an integer of at least 100')
+		if settings.slack_upload_size < 1:
+			abort('--slack-upload-size must be a positive integer')
+
+		# ...fail if we've not been told what Slack channel to use for MFA results.
+		if settings.mfa:
+			if not settings.mfa_channel:
+				abort('--mfa-channel must be specified if you\'re using --mfa without --no-slack')
+
+		# ...fail if we've not been told what Slack channel to use for public S3 results.
+		if settings.public_s3:
+			if not settings.public_s3_channel:
+				abort('--public-s3-channel must be specified if you\'re using --public-s3 without --no-slack')
+
+		# ...fail if we've not been told what Slack channel to use for IAM access key results.
+		if settings.iam_keys:
+			if not settings.iam_keys_channel:
+				abort('--iam-keys-channel must be specified if you\'re using --iam-keys without --no-slack')
+
+	# If we've been given a list of sinks...
+	if settings.sinks:
+		import sinks
+		for name in sinks.sink_names(settings):
+			# ...fail if a sink is neither one we know nor the dotted name of one to import.
+			if name not in sinks.SINKS and '.' not in name:
+				abort('--sinks must be a list of {} or dotted names of sink classes, not {}'.format(', '.join(sorted(sinks.SINKS)), name))
+
+			# ...fail if findings are to be written as JSON without saying where.
+			if name == 'json' and not settings.findings_output:
+				abort('--findings-output must be specified if --sinks includes json')
+
+			# ...fail if reports are to be posted to Slack when we've been told not to.
+			if name == 'slack' and settings.no_slack:
+				abort('--sinks can\'t include slack if you\'re suppressing Slack output with --no-slack')
+
+	# If we're supposed to check IAM keys...
+	if settings.iam_keys:
+		# ...fail if a key warning age hasn't been provided.
+		if not settings.iam_keys_warn_age:
+			abort('--iam-keys-warn-age must be specified if you\'re checking for expired IAM access keys with --iam-keys')
+
+		# ...fail if a maximum key age hasn't been provided.
+		if not settings.iam_keys_expire_age:
+			abort('--iam-keys-expire-age must be specified if you\'re checking for expired IAM access keys with --iam-keys')
+
+		# ...fail if the maximum key age isn't greater than the key warning age.
+		if settings.iam_keys_warn_age >= settings.iam_keys_expire_age:
+			abort('--iam-keys-expire-age must be greater than --iam-keys-warn-age')
+
+	# If we're supposed to check for public S3 buckets...
+	if settings.public_s3:
+		# ...fail if the number of workers isn't positive.
+		if settings.public_s3_workers < 1:
+			abort('--public-s3-workers must be a positive integer')
+
+	# If we're supposed to check other accounts...
+	if settings.accounts or settings.organization_accounts:
+		# ...fail if we've not been told what role to assume in them.
+		if not settings.assume_role_name:
+			abort('--assume-role-name must be specified if you\'re checking other accounts with --accounts or --organization-accounts')
+
+		# ...fail if the number of workers isn't positive.
+		if settings.account_workers < 1:
+			abort('--account-workers must be a positive integer')
+
+	# ...fail if the AWS client settings aren't valid.
+	if settings.aws_max_pool_connections < 1 or settings.aws_max_attempts < 1:
+		abort('--aws-max-pool-connections and --aws-max-attempts must be positive integers')
+	if settings.aws_retry_mode not in ('legacy', 'standard', 'adaptive'):
+		abort('--aws-retry-mode must be legacy, standard or adaptive')
+
+	# If we're running as a server...
+	if settings.serve:
+		# ...fail if the port isn't a valid port number.
+		if not 0 <= settings.serve_port <= 65535:
+			abort('--serve-port must be a port number')
+
+		# ...fail if the refresh interval isn't positive.
+		if settings.serve_refresh <= 0:
+			abort('--serve-refresh must be a positive number of minutes')
+
+	# If we're supposed to spread scans over several runs...
+	if settings.checkpoint_store:
+		# ...fail if the number of shards isn't positive.
+		if settings.shards < 1:
+			abort('--shards must be a positive integer')
+
+	# If we're supposed to use the credential report...
+	if settings.credential_report:
+		# ...fail if the maximum report age isn't positive.
+		if settings.credential_report_max_age <= 0:
+			abort('--credential-report-max-age must be a positive number of hours')
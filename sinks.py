@@ -0,0 +1,221 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import codecs
+import importlib
+import io
+import json
+import sys
+import tempfile
+import threading
+from collections import Counter, namedtuple
+
+# One thing a check found, e.g. a user without MFA. The finding describes the resource's state, so it changes when that gets better or worse, and the detail holds anything else worth knowing, in a form that can be written as JSON.
+Finding = namedtuple('Finding', ['check', 'resource', 'finding', 'detail'])
+
+# A part of a report: an introduction, a list of lines (e.g. user names) shown in a code block, and some closing text. Any of them may be left out.
+Section = namedtuple('Section', ['intro', 'lines', 'outro'])
+Section.__new__.__defaults__ = (None, None, None)
+
+# What we add to each message of a report that's been split over several.
+CONTINUED_MARKER = '_(continued)_'
+
+# How many bytes of a report we're uploading to Slack to keep in memory before spilling it to a temporary file.
+SPOOL_SIZE = 1024 * 1024
+
+# Somewhere findings and reports go. Each finding is passed to write(), and each check's report, a title and a list of Sections for a channel, to post(). A sink can ignore either. Sinks are made with our Bullkit, and closed at the end of the run.
+class Sink:
+	def __init__(self, bullkit):
+		self.bullkit = bullkit
+
+	def write(self, finding):
+		pass
+
+	def post(self, channel, title, sections):
+		pass
+
+	def close(self):
+		pass
+
+# Writes each finding as a line of JSON to --findings-output, so other tools can read our results without scraping messages.
+class JsonLinesSink(Sink):
+	def __init__(self, bullkit):
+		super().__init__(bullkit)
+		path = bullkit.settings.findings_output
+		self.stream = sys.stdout if path == '-' else open(path, 'w')
+
+	def write(self, finding):
+		self.stream.write('{}\n'.format(json.dumps(finding._asdict(), sort_keys=True, default=str)))
+
+	def close(self):
+		if self.stream is sys.stdout:
+			self.stream.flush()
+		else:
+			self.stream.close()
+
+# Counts the findings of each check, and summarizes them on stderr.
+class SummarySink(Sink):
+	def __init__(self, bullkit):
+		super().__init__(bullkit)
+		self.counts = Counter()
+
+	def write(self, finding):
+		self.counts[finding.check] += 1
+
+	def close(self):
+		if self.counts:
+			self.bullkit.stderr('Findings: {}.'.format(', '.join(['{} {}'.format(count, check) for check, count in sorted(self.counts.items())])))
+
+# Posts each report to its Slack channel.
+class SlackSink(Sink):
+	def post(self, channel, title, sections):
+		send_slack_report(self.bullkit, channel, title, sections)
+
+# Prints each report, to stderr if stdout is taken by --findings-output.
+class TextSink(Sink):
+	def post(self, channel, title, sections):
+		stream = sys.stderr if self.bullkit.settings.findings_output == '-' else sys.stdout
+		write_lines(stream, report_lines(sections))
+		stream.write('\n')
+
+# The sinks --sinks can name. Any other name is taken to be the dotted name of a Sink class (or any function that takes our Bullkit and returns a sink) to import.
+SINKS = {
+	'json': JsonLinesSink,
+	'slack': SlackSink,
+	'summary': SummarySink,
+	'text': TextSink,
+}
+
+# The names of the sinks we've been asked for. Without --sinks, findings are summarized, written to --findings-output if it's given, and reports are posted to Slack, or printed with --no-slack.
+def sink_names(settings):
+	if settings.sinks:
+		return [name.strip() for name in settings.sinks.split(',') if name.strip()]
+	names = ['summary']
+	if settings.findings_output:
+		names.append('json')
+	names.append('text' if settings.no_slack else 'slack')
+	return names
+
+# Make a sink from its name in --sinks.
+def make_sink(bullkit, name):
+	if name in SINKS:
+		return SINKS[name](bullkit)
+	module_name, _, attribute = name.rpartition('.')
+	return getattr(importlib.import_module(module_name), attribute)(bullkit)
+
+# Passes each finding and report to every one of our sinks. Checks may report concurrently, so findings and reports are passed on one at a time.
+class FindingPipeline:
+	def __init__(self, bullkit):
+		self.lock = threading.Lock()
+		self.sinks = [make_sink(bullkit, name) for name in sink_names(bullkit.settings)]
+
+	def write(self, findings):
+		for finding in findings:
+			with self.lock:
+				for sink in self.sinks:
+					sink.write(finding)
+
+	def post(self, channel, title, sections):
+		with self.lock:
+			for sink in self.sinks:
+				sink.post(channel, title, sections)
+
+	def close(self):
+		for sink in self.sinks:
+			sink.close()
+
+# Break a report's sections into a sequence of text and code lines. Sections are separated by blank lines.
+def report_lines(sections):
+	for index, section in enumerate(sections):
+		if index:
+			yield False, ''
+		if section.intro:
+			yield False, section.intro
+		for line in section.lines or []:
+			yield True, line
+		if section.outro:
+			yield False, section.outro
+
+# Write text and code lines to a stream as Slack would show them, putting consecutive code lines in a code block. They're written a line at a time, so a long report is never held in memory as a whole.
+def write_lines(stream, lines):
+	started = False
+	in_code = False
+	for is_code, line in lines:
+		if in_code and not is_code:
+			stream.write('```')
+		if started:
+			stream.write('\n')
+		if is_code and not in_code:
+			stream.write('```')
+		stream.write(line)
+		started = True
+		in_code = is_code
+	if in_code:
+		stream.write('```')
+
+# Render text and code lines as a Slack message.
+def render(lines):
+	rendered = io.StringIO()
+	write_lines(rendered, lines)
+	return rendered.getvalue()
+
+# The length of a report once it's rendered.
+def rendered_size(sections):
+	size = 0
+	in_code = False
+	for is_code, line in report_lines(sections):
+		size += len(line) + 1
+		if is_code and not in_code:
+			size += 6
+		in_code = is_code
+	return size
+
+# Split a report into messages of at most max_size characters, without breaking lines. Code blocks that are split are closed at the end of one message and reopened in the next.
+def split_messages(sections, max_size):
+	message = []
+	size = 0
+	in_code = False
+	for is_code, line in report_lines(sections):
+		# Leave room for the marker and code block, and cut any line that's too long to fit in a message by itself.
+		line = line[:max_size - len(CONTINUED_MARKER) - 10]
+		line_size = len(line) + 1 + (6 if is_code and not in_code else 0)
+		if message and size + line_size > max_size:
+			yield render(message)
+			message = [(False, CONTINUED_MARKER)]
+			size = len(CONTINUED_MARKER) + 1
+			in_code = False
+			line_size = len(line) + 1 + (6 if is_code else 0)
+			# Don't start a message with the blank line between sections.
+			if not is_code and not line:
+				continue
+		message.append((is_code, line))
+		size += line_size
+		in_code = is_code
+	if message:
+		yield render(message)
+
+# Post a report to a Slack channel. Short reports are posted as a single message, longer ones are split into several, and reports longer than --slack-upload-size are uploaded as a file, in the thread of a message that introduces it. The file is written to a temporary file that spills to disk, rather than rendered in memory.
+def send_slack_report(bullkit, channel, title, sections):
+	if rendered_size(sections) > bullkit.settings.slack_upload_size:
+		bullkit.debug('The {} report is too long for messages, so uploading it as a file...'.format(title))
+		spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+		write_lines(codecs.getwriter('utf-8')(spool), report_lines(sections))
+		bullkit.get_slack_dispatcher().upload(channel, spool, '{}.txt'.format(title.lower().replace(' ', '-')), title, 'This report ({}) is too long for a message, so I\'ve attached it as a file in this thread.'.format(title), username='AWS Security Bot', icon_emoji=':robot_face:')
+		return
+
+	for message in split_messages(sections, bullkit.settings.slack_message_size):
+		bullkit.send_slack_message(channel, 'AWS Security Bot', ':robot_face:', message)
@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import time
+
+# The map of AWS users to Slack users.
+USERS_FILE = 'users.yml'
+
+# How many Slack users to ask for in each page of users.list.
+USERS_LIST_PAGE_SIZE = 1000
+
+# The version of the Slack directory we cache, so we don't use one cached by an older version that indexed users differently.
+DIRECTORY_VERSION = 2
+
+# Read a JSON file from the cache directory. Returns None if there isn't one, or it can't be read.
+def read_cache(bullkit, name):
+	cache_dir = bullkit.get_cache_dir()
+	if cache_dir is None:
+		return None
+	try:
+		with open(os.path.join(cache_dir, name), 'r') as stream:
+			return json.load(stream)
+	except (IOError, OSError, ValueError):
+		return None
+
+# Write a JSON file in the cache directory, without failing the run if we can't.
+def write_cache(bullkit, name, value):
+	cache_dir = bullkit.get_cache_dir()
+	if cache_dir is None:
+		return
+	path = os.path.join(cache_dir, name)
+	try:
+		with open(path + '.tmp', 'w') as stream:
+			json.dump(value, stream)
+		os.replace(path + '.tmp', path)
+	except (IOError, OSError, TypeError, ValueError) as exc:
+		bullkit.debug('Couldn\'t save {}: {}'.format(path, exc))
+
+# Load the map of AWS users to Slack users. Parsing YAML is slow, so keep a copy as JSON in the cache directory, and only parse users.yml again when it changes. Returns None if users.yml can't be read.
+def load_users(bullkit):
+	try:
+		users_file_mtime = os.stat(USERS_FILE).st_mtime
+	except OSError:
+		bullkit.debug('{} can\'t be read, so we\'ll skip messaging Slack users directly.'.format(USERS_FILE))
+		return None
+
+	# Use the cached copy if it was made from this version of users.yml.
+	cached = read_cache(bullkit, 'users.json')
+	try:
+		if cached['path'] == os.path.abspath(USERS_FILE) and cached['mtime'] == users_file_mtime:
+			bullkit.debug('Loaded the map of AWS users to Slack users from the cache.')
+			return cached['users']
+	except (KeyError, TypeError):
+		pass
+
+	# Otherwise, parse users.yml and save a copy for next time.
+	import yaml
+	bullkit.debug('Parsing {}...'.format(USERS_FILE))
+	try:
+		with open(USERS_FILE, 'r') as stream:
+			users = yaml.safe_load(stream)
+	except (IOError, yaml.YAMLError) as exc:
+		bullkit.stderr('{} can\'t be parsed, so we\'ll skip messaging Slack users directly: {}'.format(USERS_FILE, exc))
+		return None
+	write_cache(bullkit, 'users.json', {'path': os.path.abspath(USERS_FILE), 'mtime': users_file_mtime, 'users': users})
+	return users
+
+# Load an index of Slack user IDs, email addresses, names and display names to user IDs. A key that could be several users is indexed as the user it's most specific to: an ID beats an email address, which beats a name, which beats a display name (which anyone can choose). If it's equally specific to several users, it's indexed as None, since we can't tell which one is meant. The index is fetched from users.list and kept in the cache directory until it's older than --slack-directory-ttl.
+def load_directory(bullkit):
+	cached = read_cache(bullkit, 'slack-directory.json')
+	try:
+		if cached['version'] == DIRECTORY_VERSION and time.time() - cached['fetched'] < bullkit.settings.slack_directory_ttl * 3600:
+			bullkit.debug('Loaded the Slack directory from the cache.')
+			return cached['users']
+	except (KeyError, TypeError):
+		pass
+
+	# Fetch every page of users.list.
+	bullkit.debug('Fetching the Slack directory...')
+	directory = {}
+	specificities = {}
+	slack_dispatcher = bullkit.get_slack_dispatcher()
+	params = {'limit': USERS_LIST_PAGE_SIZE}
+	while True:
+		result = slack_dispatcher.call_now('users.list', **params)
+		if result.get('ok') is not True:
+			bullkit.debug('Couldn\'t fetch the Slack directory, so we\'ll message users by name.')
+			return {}
+		for member in result['members']:
+			if member.get('deleted') or member.get('is_bot'):
+				continue
+			profile = member.get('profile', {})
+			# Keys are listed from most to least specific.
+			for specificity, key in enumerate((member['id'], profile.get('email'), member.get('name'), profile.get('display_name'))):
+				if not key:
+					continue
+				key = key.lower()
+				if key not in specificities or specificity < specificities[key]:
+					specificities[key] = specificity
+					directory[key] = member['id']
+				elif specificity == specificities[key] and directory[key] != member['id']:
+					if directory[key] is not None:
+						bullkit.debug('{} could be any of several Slack users, so we won\'t look it up.'.format(key))
+					directory[key] = None
+		params['cursor'] = result.get('response_metadata', {}).get('next_cursor')
+		if not params['cursor']:
+			break
+
+	bullkit.debug('Fetched {} entries for the Slack directory.'.format(len(directory)))
+	write_cache(bullkit, 'slack-directory.json', {'version': DIRECTORY_VERSION, 'fetched': time.time(), 'users': directory})
+	return directory
@@ -0,0 +1,263 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Two Bulls Holdings Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextvars
+import io
+import json
+import queue
+import random
+import threading
+import time
+import zlib
+import requests
+
+# How many calls per minute Slack allows each API method across the workspace, according to its rate limit tiers. chat.postMessage is special: it allows roughly one message per second per channel, which we enforce separately.
+METHOD_RATE_LIMITS = {
+	'chat.postMessage': None,
+	'files.completeUploadExternal': 20,
+	'files.getUploadURLExternal': 20,
+	'users.list': 20,
+}
+
+# The minimum number of seconds between messages to the same channel.
+CHANNEL_INTERVAL = 1.0
+
+# Errors Slack returns that are worth retrying.
+TRANSIENT_ERRORS = ('ratelimited', 'internal_error', 'fatal_error', 'service_unavailable', 'request_timeout')
+
+# How many times to try sending a call, and the bounds (in seconds) of the exponential backoff between attempts.
+MAX_ATTEMPTS = 5
+BASE_DELAY = 1
+MAX_DELAY = 30
+
+# How long (in seconds) to wait for Slack to respond to a call.
+REQUEST_TIMEOUT = 30
+
+# Sends calls to the Slack Web API from a pool of worker threads, within Slack's rate limits. Calls to the same channel are always sent by the same worker, so they arrive in the order they were queued.
+class SlackDispatcher:
+	def __init__(self, bullkit, token, api_url, workers):
+		self.bullkit = bullkit
+		self.token = token
+		self.api_url = api_url.rstrip('/') + '/'
+		self.lock = threading.Lock()
+		self.stats = {'sent': 0, 'retried': 0, 'rate limited': 0, 'failed': 0, 'unsent': 0}
+		# When we must stop sending calls, if we've been given a deadline.
+		self.deadline = None
+
+		# When we may next call each method, and when we last posted to each channel.
+		self.method_next_call = {}
+		self.channel_last_post = {}
+
+		# Share a pool of connections between the workers.
+		self.session = requests.Session()
+		self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+		self.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+
+		# Start the workers, each with its own queue.
+		self.queues = [queue.Queue() for worker in range(workers)]
+		self.threads = [threading.Thread(target=self.work, args=(worker_queue,), daemon=True) for worker_queue in self.queues]
+		for thread in self.threads:
+			thread.start()
+
+	# Queue a call to a Slack API method. It's sent in the caller's context, so our metrics count it against the check that made it.
+	def call(self, method, **params):
+		self.queue(params.get('channel', ''), self.send, method, params)
+
+	# Queue a file to be uploaded to a channel, in a thread under a message that introduces it. The file's content is read from a binary file object, which is closed once it's been sent.
+	def upload(self, channel, content, filename, title, initial_comment, **message_params):
+		self.queue(channel, self.send_file, channel, content, filename, title, initial_comment, message_params)
+
+	# Queue some work for the worker that handles a channel, to be run in the caller's context, so our metrics count it against the check that queued it.
+	def queue(self, channel, function, *args):
+		self.queues[zlib.crc32(channel.encode('utf-8')) % len(self.queues)].put((contextvars.copy_context(), function, args))
+
+	# Send a call straight away from the calling thread, within the rate limits, and return Slack's response.
+	def call_now(self, method, **params):
+		return self.send(method, params)
+
+	# Process calls from a queue until we're told to stop.
+	def work(self, worker_queue):
+		while True:
+			item = worker_queue.get()
+			if item is None:
+				return
+			context, function, args = item
+			# Once we're out of time, just count what's left.
+			if self.past_deadline():
+				self.count('unsent')
+				continue
+			context.run(function, *args)
+
+	# Whether we've passed our deadline, or would have after waiting the given number of seconds.
+	def past_deadline(self, wait=0):
+		return self.deadline is not None and time.time() + wait >= self.deadline
+
+	# How long to wait before trying a call again, with exponential backoff, but never past our deadline.
+	def backoff(self, attempt):
+		backoff = min(MAX_DELAY, BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1)
+		if self.deadline is not None:
+			backoff = max(0, min(backoff, self.deadline - time.time()))
+		return backoff
+
+	# Wait until a call is within the rate limits, and reserve its slot. Returns False if we'd pass our deadline waiting.
+	def wait_for_rate_limit(self, method, channel):
+		while True:
+			with self.lock:
+				now = time.time()
+				wait = self.method_next_call.get(method, 0) - now
+				if channel and method == 'chat.postMessage':
+					wait = max(wait, self.channel_last_post.get(channel, 0) + CHANNEL_INTERVAL - now)
+				if self.past_deadline(max(wait, 0)):
+					return False
+				if wait <= 0:
+					if METHOD_RATE_LIMITS.get(method):
+						self.method_next_call[method] = now + 60.0 / METHOD_RATE_LIMITS[method]
+					if channel and method == 'chat.postMessage':
+						self.channel_last_post[channel] = now
+					return True
+			time.sleep(wait)
+
+	# Hold off all calls to a method, e.g. because Slack told us to.
+	def pause(self, method, seconds):
+		with self.lock:
+			self.method_next_call[method] = max(self.method_next_call.get(method, 0), time.time() + seconds)
+
+	def count(self, stat):
+		with self.lock:
+			self.stats[stat] += 1
+
+	# Record a call in our metrics, if we're keeping them.
+	def record(self, method, started, attempts, rate_limited, ok):
+		if self.bullkit.settings.metrics_output:
+			self.bullkit.get_metrics().record('slack.{}'.format(method), time.time() - started, retries=attempts - 1, throttles=rate_limited, error=not ok)
+
+	# Send a call, retrying it if Slack is rate limiting us or having trouble.
+	def send(self, method, params):
+		channel = params.get('channel', params.get('channel_id', ''))
+		started = time.time()
+		rate_limited = 0
+		for attempt in range(MAX_ATTEMPTS):
+			if attempt:
+				self.count('retried')
+			if not self.wait_for_rate_limit(method, channel):
+				self.count('unsent')
+				self.record(method, started, attempt + 1, rate_limited, False)
+				self.bullkit.debug('Out of time, so not calling {} for {}.'.format(method, channel))
+				return {'ok': False, 'error': 'out_of_time'}
+			backoff = self.backoff(attempt)
+
+			try:
+				response = self.session.post(self.api_url + method, data=params, headers={'Authorization': 'Bearer {}'.format(self.token)}, timeout=REQUEST_TIMEOUT)
+			except requests.RequestException as exc:
+				self.bullkit.debug('Couldn\'t reach Slack ({}), retrying in {:.1f} seconds...'.format(exc, backoff))
+				time.sleep(backoff)
+				continue
+
+			# If we're being rate limited, wait as long as Slack asks before calling the method again.
+			if response.status_code == 429:
+				retry_after = float(response.headers.get('Retry-After', backoff))
+				self.count('rate limited')
+				rate_limited += 1
+				self.bullkit.debug('Slack rate limited {}, retrying in {:.1f} seconds...'.format(method, retry_after))
+				self.pause(method, retry_after)
+				continue
+
+			if response.status_code >= 500:
+				self.bullkit.debug('Slack returned HTTP {}, retrying in {:.1f} seconds...'.format(response.status_code, backoff))
+				time.sleep(backoff)
+				continue
+
+			try:
+				result = response.json()
+			except ValueError:
+				result = {'ok': False, 'error': 'invalid_response', 'status': response.status_code}
+			if result.get('ok') is True:
+				self.count('sent')
+				self.record(method, started, attempt + 1, rate_limited, True)
+				self.bullkit.debug('Calling {} was successful.'.format(method))
+				return result
+			if result.get('error') in TRANSIENT_ERRORS:
+				self.bullkit.debug('Slack said {}, retrying in {:.1f} seconds...'.format(result.get('error'), backoff))
+				time.sleep(backoff)
+				continue
+
+			# Anything else won't get better by retrying.
+			break
+
+		else:
+			result = {'ok': False, 'error': 'too_many_attempts'}
+
+		self.count('failed')
+		self.record(method, started, attempt + 1, rate_limited, False)
+		self.bullkit.stderr('Calling {} for {} was unsuccessful. Slack said:\n{}'.format(method, channel, result))
+		return result
+
+	# Upload a file to a channel. Slack wants it in three steps: ask for somewhere to upload it, upload it there, then share it. Sharing it needs the channel's ID rather than its name, so we post the message that introduces it first, which tells us the channel's ID, and share the file in that message's thread.
+	def send_file(self, channel, content, filename, title, initial_comment, message_params):
+		with content:
+			return self.send_file_content(channel, content, filename, title, initial_comment, message_params)
+
+	# Upload a file object's content as send_file() describes.
+	def send_file_content(self, channel, content, filename, title, initial_comment, message_params):
+		message = self.send('chat.postMessage', dict(message_params, channel=channel, text=initial_comment))
+		if not message.get('ok'):
+			return message
+		length = content.seek(0, io.SEEK_END)
+		upload = self.send('files.getUploadURLExternal', {'filename': filename, 'length': length})
+		if not upload.get('ok'):
+			return upload
+
+		# The upload URL isn't part of the Web API, so it's not rate limited, but it can still have trouble.
+		started = time.time()
+		for attempt in range(MAX_ATTEMPTS):
+			backoff = self.backoff(attempt)
+			content.seek(0)
+			try:
+				response = self.session.post(upload['upload_url'], data=content, headers={'Content-Type': 'text/plain; charset=utf-8'}, timeout=REQUEST_TIMEOUT)
+			except requests.RequestException as exc:
+				self.bullkit.debug('Couldn\'t upload {} to Slack ({}), retrying in {:.1f} seconds...'.format(filename, exc, backoff))
+				time.sleep(backoff)
+				continue
+			if response.status_code < 500:
+				break
+			self.bullkit.debug('Slack returned HTTP {} for the upload of {}, retrying in {:.1f} seconds...'.format(response.status_code, filename, backoff))
+			time.sleep(backoff)
+		else:
+			response = None
+		self.record('upload', started, attempt + 1, 0, response is not None and response.status_code == 200)
+		if response is None or response.status_code != 200:
+			self.count('failed')
+			self.bullkit.stderr('Uploading {} to {} was unsuccessful. Slack said:\n{}'.format(filename, channel, 'HTTP {}'.format(response.status_code) if response is not None else 'nothing'))
+			return {'ok': False, 'error': 'upload_failed'}
+
+		return self.send('files.completeUploadExternal', {'files': json.dumps([{'id': upload['file_id'], 'title': title}]), 'channel_id': message['channel'], 'thread_ts': message['ts']})
+
+	# Wait for every queued call to be sent, stop the workers, and return the delivery stats. If we're given a deadline (a time), calls that haven't been sent by then are counted as unsent instead, and we don't wait past it for a call that's being sent.
+	def close(self, deadline=None):
+		self.deadline = deadline
+		for worker_queue in self.queues:
+			worker_queue.put(None)
+		for thread in self.threads:
+			thread.join(None if deadline is None else max(0, deadline - time.time()))
+		with self.lock:
+			stats = dict(self.stats)
+		# Count anything a worker didn't get to because it was still sending a call.
+		for worker_queue in self.queues:
+			stats['unsent'] += len([item for item in list(worker_queue.queue) if item is not None])
+		if all([not thread.is_alive() for thread in self.threads]):
+			self.session.close()
+		return stats